@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+
+#
+# Autotuning of the stereo matching parameters (speed / quality trade-off)
+#
+
+# External dependencies
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+import cv2
+import numpy as np
+from . import Calibration
+from .Benchmark import SyntheticCalibration, SyntheticStereoPair
+from .Matcher import StereoMatcher, ComputeRightDisparity, LeftRightConsistency, matcher_backends
+from .Replay import StereoImageFiles, StereoPairName
+
+# Default parameter sweep (the penalties P1 and P2 are given as factors of 3 * block_size ** 2)
+tuning_grid = {
+	'block_size' : [ 3, 5, 7, 11 ],
+	'max_disparity' : [ 32, 64 ],
+	'smoothness' : [ ( 4, 16 ), ( 8, 32 ) ],
+	'uniqueness_ratio' : [ 5, 15 ],
+	'speckle' : [ ( 0, 0 ), ( 100, 32 ) ],
+	'backend' : [ 'bm', 'sgbm', 'hh', 'sgbm_3way', 'hh4' ],
+}
+
+# State of the worker processes
+worker = {}
+
+# Create the matching parameters of a point of the parameter sweep
+def TuningParameters( backend, block_size, max_disparity, smoothness, uniqueness_ratio, speckle ) :
+	return { 'block_size' : block_size, 'max_disparity' : max_disparity,
+		'p1' : smoothness[0] * 3 * block_size ** 2, 'p2' : smoothness[1] * 3 * block_size ** 2,
+		'uniqueness_ratio' : uniqueness_ratio, 'speckle_window_size' : speckle[0], 'speckle_range' : speckle[1], 'backend' : backend }
+
+# Return the parameters with an effect on the matching, to identify the equivalent configurations
+def EffectiveParameters( parameters ) :
+	backend = matcher_backends[ parameters['backend'] ]
+	effective = dict( ( name, value ) for name, value in parameters.items() if name not in backend.ignored_parameters )
+	effective['block_size'] = backend.BlockSize( parameters['block_size'] )
+	return tuple( sorted( effective.items() ) )
+
+# Create all the matching parameters of the parameter sweep (the first of the equivalent configurations is kept)
+def TuningConfigurations( grid = tuning_grid, samples = None ) :
+	names = sorted( grid )
+	configurations, evaluated = [], set()
+	for values in itertools.product( *( grid[ name ] for name in names ) ) :
+		parameters = TuningParameters( **dict( zip( names, values ) ) )
+		if EffectiveParameters( parameters ) in evaluated : continue
+		evaluated.add( EffectiveParameters( parameters ) )
+		configurations.append( parameters )
+	# Random subset of the sweep
+	if samples and samples < len( configurations ) : configurations = random.Random( 0 ).sample( configurations, samples )
+	return configurations
+
+# Load the rectified stereo pairs, and their ground truth disparity if available
+# The ground truth files are 16-bit PNG disparity maps (1/16 pixel) named disparity-<name>.png, as written by the batch reconstruction
+def LoadTuningPairs( pairs = None, calibration_file = None, pyramid = 1, ground_truth = None, synthetic = ( 320, 240, 64 ) ) :
+	stereo_pairs = []
+	# Synthetic pair, with a known disparity
+	if synthetic :
+		width, height, max_disparity = synthetic
+		left_image, right_image, disparity = SyntheticStereoPair( width, height, max_disparity )
+		rectified_images = Calibration.StereoRectification( SyntheticCalibration( width, height ), left_image, right_image )
+		for _ in range( pyramid ) :
+			rectified_images = cv2.pyrDown( rectified_images[0] ), cv2.pyrDown( rectified_images[1] )
+			disparity = cv2.resize( disparity, rectified_images[0].shape[1::-1], interpolation = cv2.INTER_NEAREST ) * 0.5
+		stereo_pairs.append( ( 'synthetic', rectified_images[0], rectified_images[1], disparity ) )
+	# Recorded pairs
+	if pairs :
+		calibration = Calibration.RequireCalibrationFile( calibration_file )
+		for left_file, right_file in zip( *StereoImageFiles( pairs ) ) :
+			left_image, right_image = cv2.imread( left_file ), cv2.imread( right_file )
+			if left_image is None or right_image is None : raise IOError( 'Cannot read the stereo pair {}'.format( left_file ) )
+			rectified_images = Calibration.StereoRectification( calibration, left_image, right_image )
+			for _ in range( pyramid ) :
+				rectified_images = cv2.pyrDown( rectified_images[0] ), cv2.pyrDown( rectified_images[1] )
+			# Ground truth disparity of the processed images
+			disparity = None
+			name = StereoPairName( left_file )
+			if ground_truth and os.path.isfile( '{}/disparity-{}.png'.format( ground_truth, name ) ) :
+				disparity = cv2.imread( '{}/disparity-{}.png'.format( ground_truth, name ), cv2.IMREAD_UNCHANGED ).astype( np.float32 ) / 16.0
+			stereo_pairs.append( ( left_file, rectified_images[0], rectified_images[1], disparity ) )
+	return stereo_pairs
+
+# Initialize a worker process with the stereo pairs loaded by the parent process
+def InitializeWorker( stereo_pairs ) :
+	# One core per configuration, so the runtimes are comparable
+	cv2.setNumThreads( 1 )
+	worker['pairs'] = stereo_pairs
+
+# Evaluate the matching parameters on the stereo pairs (process pool task)
+def EvaluateConfiguration( parameters, repeat = 3 ) :
+	matcher = StereoMatcher( **parameters )
+	metrics = { 'runtime_ms' : [], 'density' : [], 'lr_consistency' : [], 'mean_error_px' : [], 'bad_1px' : [] }
+	for _, left_image, right_image, ground_truth in worker['pairs'] :
+		# Fastest of the runs
+		runtimes = []
+		for _ in range( repeat ) :
+			start = time.perf_counter()
+			disparity = matcher.Compute( left_image, right_image )
+			runtimes.append( time.perf_counter() - start )
+		metrics['runtime_ms'].append( min( runtimes ) * 1000.0 )
+		# Density, and left-right consistency of the valid disparities
+		valid = disparity > max( matcher.parameters['min_disparity'] - 1, 0 )
+		consistent = LeftRightConsistency( disparity, ComputeRightDisparity( matcher, left_image, right_image ), matcher.parameters['min_disparity'] )
+		metrics['density'].append( valid.mean() )
+		metrics['lr_consistency'].append( consistent.sum() / max( valid.sum(), 1 ) )
+		# Error against the ground truth, where it is known (0 is invalid in the ground truth)
+		compared = valid & ( ground_truth > 0 ) if ground_truth is not None else None
+		if compared is not None and compared.any() :
+			error = np.abs( disparity - ground_truth )[ compared ]
+			metrics['mean_error_px'].append( error.mean() )
+			metrics['bad_1px'].append( ( error > 1 ).mean() )
+	# Average over the stereo pairs
+	metrics = dict( ( name, float( np.mean( values ) ) ) for name, values in metrics.items() if values )
+	return { 'parameters' : parameters, 'metrics' : metrics }
+
+# Find the configurations not dominated by another one
+# The objectives are ( metric name, 1 to maximize or -1 to minimize )
+def ParetoFront( results, objectives ) :
+	if not results : return []
+	scores = np.array( [ [ sign * result['metrics'][ name ] for name, sign in objectives ] for result in results ] )
+	# A configuration is dominated if another one is at least as good on every objective, and better on one
+	better_or_equal = ( scores[:, None, :] >= scores[None, :, :] ).all( axis = 2 )
+	better = ( scores[:, None, :] > scores[None, :, :] ).any( axis = 2 )
+	dominated = ( better_or_equal & better ).any( axis = 0 )
+	front = [ result for result, d in zip( results, dominated ) if not d ]
+	return sorted( front, key = lambda result : result['metrics']['runtime_ms'] )
+
+# Sweep the matching parameters in parallel on the stereo pairs
+def Autotune( configurations, pair_options, processes = None ) :
+	results = []
+	# Load the stereo pairs before starting the workers (a failing worker initialization would be restarted forever)
+	stereo_pairs = LoadTuningPairs( **pair_options )
+	if not stereo_pairs : raise IOError( 'No stereo pairs to evaluate' )
+	start = time.time()
+	pool = multiprocessing.Pool( processes, InitializeWorker, ( stereo_pairs, ) )
+	try :
+		for count, result in enumerate( pool.imap_unordered( EvaluateConfiguration, configurations ), 1 ) :
+			results.append( result )
+			print( '[{}/{}] {:.1f} ms, density {:.2f}, consistency {:.2f}'.format( count, len( configurations ),
+				result['metrics']['runtime_ms'], result['metrics']['density'], result['metrics']['lr_consistency'] ) )
+	finally :
+		pool.close()
+		pool.join()
+	print( '{} configurations evaluated in {:.1f}s'.format( len( configurations ), time.time() - start ) )
+	# Speed / quality objectives (the ground truth error replaces the consistency when available)
+	objectives = [ ( 'runtime_ms', -1 ), ( 'density', 1 ) ]
+	if all( 'mean_error_px' in result['metrics'] for result in results ) : objectives.append( ( 'mean_error_px', -1 ) )
+	else : objectives.append( ( 'lr_consistency', 1 ) )
+	return { 'objectives' : objectives, 'results' : results, 'pareto' : ParetoFront( results, objectives ) }
+
+# Short description of a tuning result
+def TuningSummary( result ) :
+	return '{:.1f} ms, density {:.2f}, consistency {:.2f}{} : {}'.format( result['metrics']['runtime_ms'],
+		result['metrics']['density'], result['metrics']['lr_consistency'],
+		', error {:.2f} px'.format( result['metrics']['mean_error_px'] ) if 'mean_error_px' in result['metrics'] else '',
+		' '.join( '{}={}'.format( name, value ) for name, value in sorted( result['parameters'].items() ) ) )
+
+# Command line interface
+def Main( argv = None ) :
+	# Command line options
+	parser = argparse.ArgumentParser( description = 'Stereo matching parameter autotuning' )
+	parser.add_argument( '-o', '--output', default = 'autotune.json', help = 'JSON report file' )
+	parser.add_argument( '-j', '--processes', type = int, help = 'Number of worker processes (all the CPU cores by default)' )
+	parser.add_argument( '--pairs', metavar = 'DIRECTORY', help = 'Directory of recorded stereo pairs (left*.png / right*.png)' )
+	parser.add_argument( '-c', '--calibration', default = '{}/calibration.pkl'.format( Calibration.calibration_directory ), help = 'Calibration file of the recorded pairs' )
+	parser.add_argument( '--ground-truth', metavar = 'DIRECTORY', help = 'Directory of the ground truth disparity maps (disparity-<name>.png)' )
+	parser.add_argument( '--pyramid', type = int, default = 1, help = 'Number of downscaling levels before matching' )
+	parser.add_argument( '--no-synthetic', dest = 'synthetic', action = 'store_false', help = 'Do not include the synthetic stereo pair' )
+	parser.add_argument( '--samples', type = int, help = 'Evaluate a random subset of the parameter sweep' )
+	args = parser.parse_args( argv )
+	# Stereo pairs loaded by each worker
+	pair_options = { 'pairs' : args.pairs, 'calibration_file' : args.calibration, 'pyramid' : args.pyramid, 'ground_truth' : args.ground_truth,
+		'synthetic' : ( 320 * 2 ** args.pyramid, 240 * 2 ** args.pyramid, 64 * 2 ** args.pyramid ) if args.synthetic else None }
+	# Run the parameter sweep
+	try : report = Autotune( TuningConfigurations( samples = args.samples ), pair_options, args.processes )
+	except IOError as error : parser.exit( 1, 'Error : {}\n'.format( error ) )
+	# Print the Pareto front
+	print( 'Pareto front :' )
+	for result in report['pareto'] : print( '  ' + TuningSummary( result ) )
+	# Write the report
+	with open( args.output, 'w' ) as output_file : json.dump( report, output_file, indent = 2, sort_keys = True )
+
+# Run the command line interface
+if __name__ == '__main__' :
+	Main()
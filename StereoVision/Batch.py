@@ -0,0 +1,152 @@
+# -*- coding:utf-8 -*-
+
+#
+# Headless batch reconstruction of recorded stereo pairs
+#
+
+# External dependencies
+import argparse
+import multiprocessing
+import os
+import time
+import cv2
+import numpy as np
+from . import Calibration
+from .Disparity import WritePly
+from .Filter import PointCloudFilter, filter_parameters
+from .Matcher import StereoMatcher, confidence_threshold, matcher_backends, matcher_parameters
+from .Reprojection import Reprojection
+from .Replay import StereoImageFiles, StereoPairName
+
+# State of the worker processes
+worker = {}
+
+# Initialize a worker process
+def InitializeWorker( calibration_file, parameters, options ) :
+	# Let the process pool use the CPU cores, not OpenCV
+	cv2.setNumThreads( 1 )
+	# Load the calibration (the rectification maps are memory-mapped, and shared between the workers)
+	worker['calibration'] = Calibration.LoadCalibrationFile( calibration_file )
+	# Create the stereo matcher
+	worker['matcher'] = StereoMatcher( **parameters )
+	# Reprojection with the disparity-to-depth matrix of the processed images
+	worker['reprojection'] = Reprojection( Calibration.DisparityToDepthMatrix( worker['calibration'], options['crop'], 0.5 ** options['pyramid'] ),
+		worker['matcher'].parameters['min_disparity'] )
+	# Point cloud filter
+	worker['filter'] = PointCloudFilter( **options['filter'] )
+	worker['options'] = options
+
+# Reconstruct a stereo pair (process pool task)
+# Return the left image filename, the processing time, and the error message if the reconstruction failed
+def ReconstructPair( task ) :
+	start = time.time()
+	try : ReconstructImages( *task )
+	except Exception as error : return task[0], time.time() - start, str( error )
+	return task[0], time.time() - start, None
+
+# Reconstruct the stereo pair of the given image files
+def ReconstructImages( left_file, right_file ) :
+	options = worker['options']
+	# Load the images
+	image_left, image_right = cv2.imread( left_file ), cv2.imread( right_file )
+	if image_left is None or image_right is None : raise IOError( 'Cannot read the stereo images' )
+	if image_left.shape != image_right.shape : raise ValueError( 'Different left and right image sizes' )
+	# Undistort the images according to the stereo camera calibration parameters
+	rectified_images = Calibration.StereoRectification( worker['calibration'], image_left, image_right, crop = options['crop'] )
+	# Downscale the images
+	for _ in range( options['pyramid'] ) :
+		rectified_images = cv2.pyrDown( rectified_images[0] ), cv2.pyrDown( rectified_images[1] )
+	# Compute the disparity, and its left-right consistency confidence if enabled
+	disparity, confidence = worker['matcher'].ComputeWithConfidence( *rectified_images )
+	# Output filename
+	name = StereoPairName( left_file )
+	# Write the disparity map (16-bit PNG, 1/16 pixel, invalid disparities set to 0)
+	if options['disparity'] :
+		cv2.imwrite( '{}/disparity-{}.png'.format( options['output'], name ),
+			np.clip( disparity * 16.0, 0, 65535 ).astype( np.uint16 ) )
+		# Write the confidence map (8-bit PNG)
+		if confidence is not None :
+			cv2.imwrite( '{}/confidence-{}.png'.format( options['output'], name ), ( confidence * 255 + 0.5 ).astype( np.uint8 ) )
+	# Write the point cloud of the valid disparities
+	if options['ply'] :
+		valid = confidence >= confidence_threshold if confidence is not None else None
+		coordinates, colors = worker['reprojection'].Compute( disparity, rectified_images[0], valid )
+		coordinates, colors = worker['filter'].Apply( coordinates, colors )
+		if len( coordinates ) : WritePly( '{}/stereo-{}.ply'.format( options['output'], name ), coordinates, colors )
+
+# Read a list of stereo pairs (one "left right" pair per line)
+def ReadPairList( filename ) :
+	left_files, right_files = [], []
+	with open( filename ) as pair_file :
+		for line in pair_file :
+			if not line.strip() or line.startswith( '#' ) : continue
+			left_file, right_file = line.split()
+			left_files.append( left_file )
+			right_files.append( right_file )
+	return left_files, right_files
+
+# Reconstruct the given stereo pairs with a process pool
+def BatchReconstruction( calibration_file, left_files, right_files, output = '.', parameters = None,
+		processes = None, chunksize = 4, crop = False, pyramid = 0, disparity = True, ply = True, point_filter = None ) :
+	# Check the calibration before starting the workers (a failing worker initialization would be restarted forever)
+	Calibration.RequireCalibrationFile( calibration_file )
+	# Create the output directory
+	if not os.path.isdir( output ) : os.makedirs( output )
+	# Processing options
+	options = { 'output' : output, 'crop' : crop, 'pyramid' : pyramid, 'disparity' : disparity, 'ply' : ply, 'filter' : point_filter or {} }
+	# Shard the pairs over the worker processes
+	start = time.time()
+	failed = 0
+	pool = multiprocessing.Pool( processes, InitializeWorker, ( calibration_file, parameters or {}, options ) )
+	try :
+		for count, ( filename, duration, error ) in enumerate( pool.imap_unordered( ReconstructPair,
+				zip( left_files, right_files ), chunksize ), 1 ) :
+			if error :
+				failed += 1
+				print( '[{}/{}] Cannot reconstruct {} ({})...'.format( count, len( left_files ), filename, error ) )
+			else : print( '[{}/{}] {} ({:.3f}s)'.format( count, len( left_files ), filename, duration ) )
+	finally :
+		pool.close()
+		pool.join()
+	# Overall throughput
+	duration = time.time() - start
+	print( '{} pairs reconstructed in {:.1f}s ({:.2f} pairs/s), {} failed'.format( len( left_files ) - failed, duration,
+		len( left_files ) / max( duration, 1e-9 ), failed ) )
+	return failed
+
+# Command line interface
+def Main( argv = None ) :
+	# Command line options
+	parser = argparse.ArgumentParser( description = 'Headless batch stereo reconstruction' )
+	parser.add_argument( 'input', help = 'Directory of stereo pairs (left*.png / right*.png), or file listing one "left right" pair per line' )
+	parser.add_argument( '-c', '--calibration', default = '{}/calibration.pkl'.format( Calibration.calibration_directory ), help = 'Calibration file' )
+	parser.add_argument( '-o', '--output', default = '.', help = 'Output directory' )
+	parser.add_argument( '-j', '--processes', type = int, help = 'Number of worker processes (all the CPU cores by default)' )
+	parser.add_argument( '--chunksize', type = int, default = 4, help = 'Number of pairs sent to a worker at once' )
+	parser.add_argument( '--crop', action = 'store_true', help = 'Crop the rectified images to the valid region' )
+	parser.add_argument( '--pyramid', type = int, default = 1, help = 'Number of downscaling levels before matching' )
+	parser.add_argument( '--no-disparity', dest = 'disparity', action = 'store_false', help = 'Do not write the disparity maps' )
+	parser.add_argument( '--no-ply', dest = 'ply', action = 'store_false', help = 'Do not write the point clouds' )
+	for name, value in sorted( matcher_parameters.items() ) :
+		parser.add_argument( '--{}'.format( name.replace( '_', '-' ) ), type = type( value ), default = value,
+			choices = sorted( matcher_backends ) if name == 'backend' else None )
+	for name, value in sorted( filter_parameters.items() ) :
+		parser.add_argument( '--{}'.format( name.replace( '_', '-' ) ), type = type( value ), default = value, help = 'Point cloud filter (0 to disable)' )
+	args = parser.parse_args( argv )
+	# Stereo pairs
+	if os.path.isdir( args.input ) : left_files, right_files = StereoImageFiles( args.input )
+	else : left_files, right_files = ReadPairList( args.input )
+	# Matching parameters
+	parameters = dict( ( name, getattr( args, name ) ) for name in matcher_parameters )
+	# Point cloud filter parameters
+	point_filter = dict( ( name, getattr( args, name ) ) for name in filter_parameters )
+	# Reconstruct the stereo pairs
+	try :
+		failed = BatchReconstruction( args.calibration, left_files, right_files, args.output, parameters,
+			args.processes, args.chunksize, args.crop, args.pyramid, args.disparity, args.ply, point_filter )
+	except IOError as error : parser.exit( 1, 'Error : {}\n'.format( error ) )
+	if failed : parser.exit( 1 )
+
+# Run the command line interface
+if __name__ == '__main__' :
+	Main()
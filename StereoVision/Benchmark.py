@@ -0,0 +1,262 @@
+# -*- coding:utf-8 -*-
+
+#
+# Stage-level benchmark of the stereo processing chain
+#
+
+# External dependencies
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from . import Calibration
+from .Disparity import DisparityColormap, WritePly
+from .Filter import PointCloudFilter
+from .Fusion import VoxelMap
+from .Matcher import StereoMatcher
+from .Replay import StereoImageFiles
+from .Reprojection import Reprojection
+
+# Default image resolutions ( width, height )
+benchmark_resolutions = ( ( 320, 240 ), ( 640, 480 ), ( 1280, 720 ) )
+
+# Default disparity ranges (SGBM number of disparities)
+benchmark_disparities = ( 16, 64, 128 )
+
+# Create a synthetic stereo pair with a known disparity map (textured plane)
+def SyntheticStereoPair( width, height, max_disparity, seed = 0 ) :
+	# Random texture, smoothed to be matchable
+	random = np.random.RandomState( seed )
+	texture = random.randint( 0, 256, ( height, width + max_disparity, 3 ) ).astype( np.uint8 )
+	texture = cv2.GaussianBlur( texture, ( 5, 5 ), 1.0 )
+	# Slanted plane, with the disparity increasing from the top to the bottom of the image
+	disparity = np.empty( ( height, width ), np.float32 )
+	disparity[:] = ( max_disparity * ( 0.25 + 0.5 * np.arange( height, dtype=np.float32 ) / height ) )[:, None]
+	# Right image, and left image shifted by the disparity
+	x, y = np.meshgrid( np.arange( width, dtype=np.float32 ), np.arange( height, dtype=np.float32 ) )
+	right_image = np.ascontiguousarray( texture[:, max_disparity:] )
+	left_image = cv2.remap( texture, x + max_disparity - disparity, y, cv2.INTER_LINEAR )
+	return left_image, right_image, disparity
+
+# Create an ideal stereo calibration (no distortion, parallel cameras)
+def SyntheticCalibration( width, height, focal = None, baseline = 100.0 ) :
+	focal = focal if focal else float( width )
+	camera_matrix = np.array( [ [ focal, 0, width / 2.0 ], [ 0, focal, height / 2.0 ], [ 0, 0, 1 ] ] )
+	calibration = Calibration.StereoCalibration( {
+		'img_size' : ( width, height ),
+		'camera_matrix_l' : camera_matrix, 'dist_coefs_l' : np.zeros( 5 ),
+		'camera_matrix_r' : camera_matrix, 'dist_coefs_r' : np.zeros( 5 ),
+		'R1' : np.identity( 3 ), 'R2' : np.identity( 3 ),
+		'P1' : np.hstack( [ camera_matrix, np.zeros( ( 3, 1 ) ) ] ),
+		'P2' : np.hstack( [ camera_matrix, [ [ -focal * baseline ], [ 0 ], [ 0 ] ] ] ),
+		'Q' : np.array( [ [ 1, 0, 0, -width / 2.0 ], [ 0, 1, 0, -height / 2.0 ], [ 0, 0, 0, focal ], [ 0, 0, 1.0 / baseline, 0 ] ] ),
+		'ROI1' : ( 0, 0, width, height ), 'ROI2' : ( 0, 0, width, height ) } )
+	calibration['left_map'], calibration['right_map'] = Calibration.RectificationMaps( calibration )
+	return calibration
+
+# Get the disparity range at half resolution (multiple of 16 required by SGBM)
+def HalfDisparityRange( max_disparity ) :
+	return max( 16, max_disparity // 32 * 16 )
+
+# Measure the latency and the peak memory of a function
+def TimeStage( function, repeat = 20, warmup = 2 ) :
+	# Warm up the caches
+	for _ in range( warmup ) : function()
+	# Peak memory of a single run (Python and NumPy allocations)
+	tracemalloc.start()
+	result = function()
+	peak_memory = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	# Latency of each run
+	timings = []
+	for _ in range( repeat ) :
+		start = time.perf_counter()
+		function()
+		timings.append( time.perf_counter() - start )
+	timings = np.array( timings ) * 1000.0
+	# Stage report
+	report = { 'runs' : repeat, 'mean_ms' : timings.mean(), 'throughput_fps' : 1000.0 / timings.mean(), 'peak_memory_bytes' : peak_memory }
+	for percentile in ( 50, 90, 99 ) : report['p{}_ms'.format( percentile )] = np.percentile( timings, percentile )
+	return result, dict( ( key, float( value ) ) for key, value in report.items() )
+
+# Create an offscreen point cloud viewer, if a display is available
+def CreateViewer() :
+	try :
+		from PySide import QtCore, QtGui
+		from .PointCloud import PointCloudViewer
+		application = QtGui.QApplication.instance() or QtGui.QApplication( sys.argv[:1] )
+		viewer = PointCloudViewer()
+		viewer.setAttribute( QtCore.Qt.WA_DontShowOnScreen )
+		viewer.show()
+		application.processEvents()
+		viewer.makeCurrent()
+		return application, viewer
+	except Exception as error :
+		print( 'Point cloud viewer benchmark skipped ({})...'.format( error ), file = sys.stderr )
+		return None, None
+
+# Measure the density of a disparity map, and its error against the ground truth if available (compared at the disparity resolution)
+def DisparityQuality( disparity, min_disparity = 0, ground_truth = None ) :
+	valid = disparity > max( min_disparity - 1, 0 )
+	quality = { 'density' : float( valid.mean() ) }
+	if ground_truth is not None :
+		ground_truth = cv2.resize( ground_truth, disparity.shape[::-1], interpolation = cv2.INTER_NEAREST ) * disparity.shape[1] / ground_truth.shape[1]
+		error = np.abs( disparity - ground_truth )[ valid ]
+		quality['mean_error_px'] = float( error.mean() ) if error.size else None
+		quality['bad_1px'] = float( ( error > 1 ).mean() ) if error.size else None
+	return quality
+
+# Benchmark each stage of the processing chain on a stereo pair
+def BenchmarkPair( calibration, left_image, right_image, parameters, repeat = 20, viewer = None, ground_truth = None ) :
+	report = {}
+	matcher = StereoMatcher( **parameters )
+	# Rectification
+	full_images, report['rectification'] = TimeStage( lambda : Calibration.StereoRectification( calibration, left_image, right_image ), repeat )
+	# Downscaling
+	rectified_images, report['pyramid'] = TimeStage( lambda : ( cv2.pyrDown( full_images[0] ), cv2.pyrDown( full_images[1] ) ), repeat )
+	# Disparity
+	disparity, report['disparity'] = TimeStage( lambda : matcher.Compute( *rectified_images ), repeat )
+	report['quality'] = DisparityQuality( disparity, matcher.parameters['min_disparity'], ground_truth )
+	# Full resolution disparity, matched coarse-to-fine
+	coarse_matcher = StereoMatcher( **dict( parameters, max_disparity = 2 * matcher.parameters['max_disparity'], coarse_levels = 1 ) )
+	full_disparity, report['disparity_coarse_to_fine'] = TimeStage( lambda : coarse_matcher.Compute( *full_images ), repeat )
+	report['disparity_coarse_to_fine'].update( DisparityQuality( full_disparity, coarse_matcher.parameters['min_disparity'], ground_truth ) )
+	# Disparity image for display (colormap lookup at the camera resolution)
+	colormap = DisparityColormap( matcher.parameters['min_disparity'], matcher.parameters['max_disparity'] )
+	display = np.zeros( full_images[0].shape[:2] + ( 4, ), np.uint8 )
+	_, report['disparity_image'] = TimeStage( lambda : colormap.Apply( disparity, display ), repeat )
+	# Point cloud reprojection of the valid disparities
+	reprojection = Reprojection( Calibration.DisparityToDepthMatrix( calibration, scale = 0.5 ), matcher.parameters['min_disparity'] )
+	point_cloud, report['point_cloud'] = TimeStage( lambda : reprojection.Compute( disparity, rectified_images[0] ), repeat )
+	report['point_cloud']['points'] = len( point_cloud[0] )
+	# Point cloud filtering (voxel size relative to the scene depth)
+	if len( point_cloud[0] ) :
+		voxel_size = float( np.median( point_cloud[0][:, 2] ) ) / 100.0
+		point_filter = PointCloudFilter( voxel_size = voxel_size, outlier_radius = 2.0 * voxel_size )
+		filtered_cloud, report['point_filter'] = TimeStage( lambda : point_filter.Apply( *point_cloud ), repeat )
+		report['point_filter']['points'] = len( filtered_cloud[0] )
+		# Point cloud fusion into a voxel map (the map is already populated after the warm-up)
+		voxel_map = VoxelMap( voxel_size )
+		_, report['fusion'] = TimeStage( lambda : voxel_map.Integrate( *point_cloud ), repeat )
+		report['fusion']['voxels'] = len( voxel_map )
+	# Point cloud upload to the GPU
+	if viewer is not None :
+		import OpenGL.GL as gl
+		_, report['viewer_upload'] = TimeStage( lambda : ( viewer.UpdatePointCloud( *point_cloud ), gl.glFinish() ), repeat )
+		_, report['viewer_disparity_upload'] = TimeStage( lambda : ( viewer.UpdateDisparity( disparity, rectified_images[0],
+			reprojection.Q, reprojection.min_disparity ), gl.glFinish() ), repeat )
+	# Point cloud export
+	ply_file, ply_filename = tempfile.mkstemp( suffix = '.ply' )
+	os.close( ply_file )
+	try :
+		_, report['write_ply'] = TimeStage( lambda : WritePly( ply_filename, *point_cloud ), max( 1, repeat // 5 ), 0 )
+		report['write_ply']['file_bytes'] = os.path.getsize( ply_filename )
+	finally : os.remove( ply_filename )
+	return report
+
+# Compare the vectorized projection of the calibration with OpenCV, for the distortion models with 5, 8 and 14 coefficients
+# Return the maximum difference (pixels) for each model
+def ProjectionCheck( views = 10, seed = 0 ) :
+	random = np.random.RandomState( seed )
+	# Chessboard views in front of the camera
+	obj_points = np.zeros( ( views, 9 * 6, 3 ) )
+	obj_points[:, :, :2] = np.indices( ( 9, 6 ) ).T.reshape( -1, 2 ) * 25.0
+	rvecs = random.uniform( -0.3, 0.3, ( views, 3 ) )
+	tvecs = np.column_stack( ( random.uniform( -100.0, 0.0, ( views, 2 ) ), random.uniform( 400.0, 800.0, views ) ) )
+	camera_matrix = np.array( [ [ 500.0, 0.0, 320.0 ], [ 0.0, 500.0, 240.0 ], [ 0.0, 0.0, 1.0 ] ] )
+	# Distortion models (the 14 coefficient one is returned by the rational model calibration, with zero thin prism and tilt terms)
+	distortion = np.array( [ -0.2, 0.05, 0.001, -0.001, 0.01, 0.02, 0.005, 0.001 ] )
+	errors = {}
+	for count in ( 5, 8, 14 ) :
+		dist_coefs = np.zeros( count )
+		dist_coefs[:min( count, 8 )] = distortion[:count]
+		projected = Calibration.ProjectPoints( obj_points, rvecs, tvecs, camera_matrix, dist_coefs )
+		reference = np.array( [ cv2.projectPoints( obj, r, t, camera_matrix, dist_coefs )[0].reshape( -1, 2 )
+			for obj, r, t in zip( obj_points, rvecs, tvecs ) ] )
+		errors[ '{}_coefficients'.format( count ) ] = float( np.abs( projected - reference ).max() )
+	return errors
+
+# Get the current revision of the source code, if available
+def SourceRevision() :
+	try :
+		return subprocess.check_output( [ 'git', 'describe', '--always', '--dirty' ],
+			cwd = os.path.dirname( os.path.abspath( __file__ ) ), stderr = subprocess.STDOUT ).decode().strip()
+	except ( OSError, subprocess.CalledProcessError ) : return None
+
+# Run the benchmark suite
+def Benchmark( resolutions = benchmark_resolutions, disparities = benchmark_disparities, repeat = 20,
+		pairs = None, calibration_file = None, viewer = False ) :
+	# Environment description, to compare the revisions
+	results = { 'revision' : SourceRevision(), 'python' : platform.python_version(), 'platform' : platform.platform(),
+		'opencv' : cv2.__version__, 'numpy' : np.__version__, 'cpu_count' : os.cpu_count(), 'benchmarks' : [] }
+	# Calibration of the recorded stereo pairs, checked before running the benchmarks
+	pair_calibration = Calibration.RequireCalibrationFile( calibration_file ) if pairs else None
+	# Check the vectorized projection against OpenCV
+	results['projection_check'] = ProjectionCheck()
+	if max( results['projection_check'].values() ) > 1e-6 :
+		print( 'Vectorized projection differs from OpenCV : {}'.format( results['projection_check'] ), file = sys.stderr )
+	# Offscreen viewer
+	application, viewer = CreateViewer() if viewer else ( None, None )
+	# Synthetic stereo pairs
+	for width, height in resolutions :
+		calibration = SyntheticCalibration( width, height )
+		for max_disparity in disparities :
+			print( 'Synthetic {}x{}, {} disparities...'.format( width, height, max_disparity ), file = sys.stderr )
+			left_image, right_image, ground_truth = SyntheticStereoPair( width, height, max_disparity )
+			report = BenchmarkPair( calibration, left_image, right_image, { 'max_disparity' : HalfDisparityRange( max_disparity ) },
+				repeat, viewer, ground_truth )
+			results['benchmarks'].append( { 'source' : 'synthetic', 'width' : width, 'height' : height,
+				'max_disparity' : max_disparity, 'stages' : report } )
+	# Recorded stereo pairs
+	if pairs :
+		for left_file, right_file in zip( *StereoImageFiles( pairs ) ) :
+			left_image, right_image = cv2.imread( left_file ), cv2.imread( right_file )
+			if left_image is None or right_image is None : raise IOError( 'Cannot read the stereo pair {}'.format( left_file ) )
+			for max_disparity in disparities :
+				print( 'Recorded {}, {} disparities...'.format( left_file, max_disparity ), file = sys.stderr )
+				report = BenchmarkPair( pair_calibration, left_image, right_image, { 'max_disparity' : HalfDisparityRange( max_disparity ) }, repeat, viewer )
+				results['benchmarks'].append( { 'source' : left_file, 'width' : left_image.shape[1], 'height' : left_image.shape[0],
+					'max_disparity' : max_disparity, 'stages' : report } )
+	# Peak resident memory of the process
+	try :
+		import resource
+		results['max_rss_kb'] = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	except ImportError : pass
+	return results
+
+# Command line interface
+def Main( argv = None ) :
+	# Command line options
+	parser = argparse.ArgumentParser( description = 'Stage-level benchmark of the stereo processing chain' )
+	parser.add_argument( '-o', '--output', help = 'JSON report file (standard output by default)' )
+	parser.add_argument( '-r', '--repeat', type = int, default = 20, help = 'Number of timed runs per stage' )
+	parser.add_argument( '--resolutions', nargs = '+', default = [ '{}x{}'.format( *r ) for r in benchmark_resolutions ], help = 'Synthetic image resolutions (WxH)' )
+	parser.add_argument( '--disparities', nargs = '+', type = int, default = list( benchmark_disparities ), help = 'Disparity ranges (full resolution)' )
+	parser.add_argument( '--pairs', metavar = 'DIRECTORY', help = 'Directory of recorded stereo pairs (left*.png / right*.png)' )
+	parser.add_argument( '-c', '--calibration', default = '{}/calibration.pkl'.format( Calibration.calibration_directory ), help = 'Calibration file of the recorded pairs' )
+	parser.add_argument( '--viewer', action = 'store_true', help = 'Benchmark the point cloud upload (requires a display)' )
+	args = parser.parse_args( argv )
+	# Run the benchmarks
+	resolutions = [ tuple( int( v ) for v in r.lower().split( 'x' ) ) for r in args.resolutions ]
+	# Progress messages go to the standard error, so the report can be redirected from the standard output
+	try :
+		with contextlib.redirect_stdout( sys.stderr ) :
+			results = Benchmark( resolutions, args.disparities, args.repeat, args.pairs, args.calibration, args.viewer )
+	except IOError as error : parser.exit( 1, 'Error : {}\n'.format( error ) )
+	# Write the report
+	report = json.dumps( results, indent = 2, sort_keys = True )
+	if args.output :
+		with open( args.output, 'w' ) as output_file : output_file.write( report )
+	else : print( report )
+
+# Run the command line interface
+if __name__ == '__main__' :
+	Main()
@@ -6,11 +6,16 @@
 
 # External dependencies
 import glob
+import hashlib
 import math
+import multiprocessing
 import os
 import pickle
+import threading
+import time
 import cv2
 import numpy as np
+from .Pipeline import FrameBuffer
 
 # Calibration pattern size
 pattern_size = ( 9, 6 )
@@ -18,41 +23,395 @@ pattern_size = ( 9, 6 )
 # Image scale factor for pattern detection
 image_scale = 0.5
 
+# Image scale factor, and minimum time between two detections (seconds), for the live pattern preview
+preview_scale = 0.5
+preview_interval = 0.2
+
+# Number of processes used for pattern detection (all the CPU cores if None)
+detection_processes = None
+
 # Calibration directory setup
 calibration_directory = 'Calibration'
 
+# Chessboard detection cache file (in the calibration directory)
+detection_cache_filename = 'chessboard.pkl'
+
+# Calibration file format version
+calibration_version = 2
+
+# Rectification maps, stored as raw arrays next to the calibration file
+calibration_maps = ( 'left_map', 'right_map' )
+
+# Calibration dataset, stored in a separate file next to the calibration file
+calibration_dataset = ( 'img_files', 'img_points', 'obj_points', 'rvecs', 'tvecs', 'corner_errors', 'view_errors' )
+
+# Calibration parameters, with the large arrays loaded on demand
+class StereoCalibration( dict ) :
+	# Initialisation
+	def __init__( self, parameters = (), filename = None ) :
+		# Initialise the dictionary with the calibration parameters
+		super( StereoCalibration, self ).__init__( parameters )
+		# Calibration file (header)
+		self.filename = filename
+	# Load a parameter not in the header
+	def __missing__( self, key ) :
+		# Rectification maps
+		if key in calibration_maps :
+			self[key] = LoadRectificationMap( self, key )
+		# Calibration dataset
+		elif key in calibration_dataset and self.filename :
+			with open( CalibrationArrayFile( self.filename, 'dataset', 'pkl' ), 'rb' ) as dataset_file :
+				self.update( pickle.load( dataset_file ) )
+		# Return the requested parameter
+		return dict.__getitem__( self, key )
+
+# Get the filename of an array stored next to the calibration file
+def CalibrationArrayFile( filename, name, extension = 'npy' ) :
+	return '{}-{}.{}'.format( os.path.splitext( filename )[0], name, extension )
+
+# Compute the rectification maps from the calibration parameters
+def RectificationMaps( calibration ) :
+	left_map = cv2.initUndistortRectifyMap(
+		calibration['camera_matrix_l'], calibration['dist_coefs_l'],
+		calibration['R1'], calibration['P1'], calibration['img_size'], cv2.CV_16SC2 )
+	right_map = cv2.initUndistortRectifyMap(
+		calibration['camera_matrix_r'], calibration['dist_coefs_r'],
+		calibration['R2'], calibration['P2'], calibration['img_size'], cv2.CV_16SC2 )
+	return left_map, right_map
+
+# Memory-map a rectification map, or compute it if not available
+def LoadRectificationMap( calibration, name ) :
+	# Map files
+	filenames = [ CalibrationArrayFile( calibration.filename, '{}{}'.format( name, i ) ) for i in ( 1, 2 ) ] if calibration.filename else []
+	if filenames and all( os.path.isfile( filename ) for filename in filenames ) :
+		return tuple( np.load( filename, mmap_mode = 'c' ) for filename in filenames )
+	# Rebuild the maps from the calibration parameters
+	print( 'Compute the rectification maps...' )
+	left_map, right_map = RectificationMaps( calibration )
+	dict.__setitem__( calibration, 'left_map', left_map )
+	dict.__setitem__( calibration, 'right_map', right_map )
+	return calibration[name]
+
 # Create the calibration directory
 def CreateCalibrationDirectory() :
 	try : os.makedirs( calibration_directory )
 	except OSError :
 		if not os.path.isdir( calibration_directory ) : raise
 
-# Load the calibration parameters from a file
+# Load the calibration parameters from a file of the calibration directory
 def LoadCalibration( filename = 'calibration.pkl' ) :
+	return LoadCalibrationFile( '{}/{}'.format( calibration_directory, filename ) )
+
+# Load the calibration parameters from the given file path, and check them before any processing
+# Raise IOError if the file is missing or invalid
+def RequireCalibrationFile( filename ) :
+	try :
+		calibration = LoadCalibrationFile( filename )
+		# Parameters used by the rectification and the reprojection
+		if calibration is not None : calibration['left_map'], calibration['right_map'], calibration['Q'], RectificationROI( calibration )
+	except Exception as error : raise IOError( 'Invalid calibration file {} ({})'.format( filename, error ) )
+	if calibration is None : raise IOError( 'Calibration file {} not found'.format( filename ) )
+	return calibration
+
+# Load the calibration parameters from the given file path (None if the file does not exist)
+def LoadCalibrationFile( filename ) :
 	calibration = None
-	if os.path.isfile( '{}/{}'.format( calibration_directory, filename ) ) :
-		with open( '{}/{}'.format( calibration_directory, filename ) , 'rb' ) as calibration_file :
+	if os.path.isfile( filename ) :
+		with open( filename, 'rb' ) as calibration_file :
 			calibration = pickle.load( calibration_file )
+		# Calibration header, with the large arrays stored in separate files
+		if calibration.get( 'version', 1 ) >= 2 : calibration = StereoCalibration( calibration, filename )
+		# Older calibration file with all the parameters, convert the rectification maps
+		else : calibration = ConvertRectificationMaps( StereoCalibration( calibration ) )
 	return calibration
 
+# Save an array to a file, through a temporary file renamed over the previous one
+# The previous file may be memory-mapped by a loaded calibration : it keeps its content until it is unmapped
+def SaveArrayFile( filename, array ) :
+	temporary_filename = '{}.tmp'.format( filename )
+	with open( temporary_filename, 'wb' ) as array_file : np.save( array_file, array )
+	os.replace( temporary_filename, filename )
+
 # Save the calibration parameters to a file
 def SaveCalibration( calibration, filename = 'calibration.pkl' ) :
-	# Write the calibration object with all the parameters
-	with open( '{}/{}'.format( calibration_directory, filename ) , 'wb') as calibration_file :
-		pickle.dump( calibration, calibration_file, pickle.HIGHEST_PROTOCOL )
-
-# Find the chessboard quickly, and draw it
-def PreviewChessboard( image ) :
-	# Find the chessboard corners on the image
-	found, corners = cv2.findChessboardCorners( image, pattern_size, flags = cv2.CALIB_CB_FAST_CHECK )
-#	found, corners = cv2.findCirclesGridDefault( image, pattern_size, flags = cv2.CALIB_CB_ASYMMETRIC_GRID )
-	# Draw the chessboard corners on the image
-	if found : cv2.drawChessboardCorners( image, pattern_size, corners, found )
-	# Return the image with the chessboard if found
-	return image
+	filename = '{}/{}'.format( calibration_directory, filename )
+	# Split the parameters from the large arrays (not loaded ones are left untouched)
+	header = { 'version' : calibration_version }
+	dataset = {}
+	for key, value in dict.items( calibration ) :
+		if key in calibration_maps :
+			# Maps already memory-mapped from the destination files
+			if getattr( value[0], 'filename', None ) == os.path.abspath( CalibrationArrayFile( filename, '{}1'.format( key ) ) ) : continue
+			SaveArrayFile( CalibrationArrayFile( filename, '{}1'.format( key ) ), value[0] )
+			SaveArrayFile( CalibrationArrayFile( filename, '{}2'.format( key ) ), value[1] )
+		elif key in calibration_dataset : dataset[key] = value
+		elif key != 'version' : header[key] = value
+	# Write the calibration dataset
+	if dataset :
+		with open( CalibrationArrayFile( filename, 'dataset', 'pkl' ), 'wb' ) as dataset_file :
+			pickle.dump( dataset, dataset_file, pickle.HIGHEST_PROTOCOL )
+	# Write the calibration parameters
+	with open( filename, 'wb' ) as calibration_file :
+		pickle.dump( header, calibration_file, pickle.HIGHEST_PROTOCOL )
+
+# Convert the rectification maps to the compact fixed-point representation
+def ConvertRectificationMaps( calibration ) :
+	for name in ( 'left_map', 'right_map' ) :
+		# Floating-point maps (x and y coordinates)
+		if calibration[name][0].dtype == np.float32 :
+			calibration[name] = cv2.convertMaps( calibration[name][0], calibration[name][1], cv2.CV_16SC2 )
+	return calibration
+
+# Get the intersection of the left and right valid image regions ( x0, y0, x1, y1 )
+def RectificationROI( calibration ) :
+	( x1, y1, w1, h1 ), ( x2, y2, w2, h2 ) = calibration['ROI1'], calibration['ROI2']
+	x0, y0 = max( x1, x2 ), max( y1, y2 )
+	x1, y1 = min( x1 + w1, x2 + w2 ), min( y1 + h1, y2 + h2 )
+	# Use the whole image if the regions do not overlap
+	if x1 <= x0 or y1 <= y0 : return ( 0, 0 ) + tuple( calibration['left_map'][0].shape[1::-1] )
+	return x0, y0, x1, y1
+
+# Get the disparity-to-depth matrix for cropped and / or downscaled rectified images
+def DisparityToDepthMatrix( calibration, crop = False, scale = 1.0 ) :
+	# Pixel and disparity scale ( x, y, d ) to the full resolution
+	transformation = np.diag( [ 1.0 / scale, 1.0 / scale, 1.0 / scale, 1.0 ] )
+	# Offset of the cropped region
+	if crop : transformation[:2, 3] = RectificationROI( calibration )[:2]
+	return np.dot( calibration['Q'], transformation )
+
+# Load the chessboard detection cache from a file
+def LoadDetectionCache( filename = detection_cache_filename ) :
+	cache = {}
+	if os.path.isfile( '{}/{}'.format( calibration_directory, filename ) ) :
+		with open( '{}/{}'.format( calibration_directory, filename ) , 'rb' ) as cache_file :
+			try : cache = pickle.load( cache_file )
+			except ( pickle.UnpicklingError, EOFError ) : print( 'Invalid chessboard detection cache...' )
+	return cache
+
+# Save the chessboard detection cache to a file
+def SaveDetectionCache( cache, filename = detection_cache_filename ) :
+	with open( '{}/{}'.format( calibration_directory, filename ) , 'wb') as cache_file :
+		pickle.dump( cache, cache_file, pickle.HIGHEST_PROTOCOL )
+
+# Compute the key of an image in the chessboard detection cache
+def DetectionCacheKey( filename ) :
+	# Hash the file content
+	digest = hashlib.sha1()
+	with open( filename, 'rb' ) as image_file :
+		for block in iter( lambda : image_file.read( 1 << 20 ), b'' ) : digest.update( block )
+	# The detection depends on the image content and the pattern size
+	return digest.hexdigest(), tuple( pattern_size )
+
+# Thread to find the chessboard on the live stereo images, for the preview
+# The detection runs on downscaled images at a throttled rate, and the latest corners are drawn on every frame
+class ChessboardPreview( threading.Thread ) :
+	# Initialisation
+	def __init__( self, scale = preview_scale, interval = preview_interval ) :
+		# Initialize the thread
+		super( ChessboardPreview, self ).__init__()
+		self.daemon = True
+		# Detection image scale, and minimum time between two detections
+		self.scale = scale
+		self.interval = interval
+		# Latest stereo images to analyze
+		self.buffer = FrameBuffer()
+		# Latest detection on each camera : pattern found, pattern size, and corner positions at full resolution
+		self.detections = [ ( False, None, None ), ( False, None, None ) ]
+		# Number of detections
+		self.detected = 0
+	# Pattern found on each camera by the latest detection
+	@property
+	def found( self ) :
+		return tuple( detection[0] for detection in self.detections )
+	# Start the detection
+	def StartPreview( self ) :
+		self.running = True
+		self.start()
+	# Stop the detection
+	def StopPreview( self ) :
+		self.running = False
+		self.buffer.Close()
+		self.join()
+	# Send the latest stereo images (the images must not be modified afterwards)
+	def Put( self, images ) :
+		self.buffer.Put( images )
+	# Find the chessboard on a downscaled copy of the image
+	def Detect( self, image ) :
+		size = tuple( pattern_size )
+		image_small = cv2.resize( image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA )
+		if image_small.ndim == 3 : image_small = cv2.cvtColor( image_small, cv2.COLOR_BGR2GRAY )
+		found, corners = cv2.findChessboardCorners( image_small, size, flags = cv2.CALIB_CB_FAST_CHECK )
+		# Rescale the corner positions to the full resolution image
+		if not found : return False, size, None
+		return True, size, ( corners + 0.5 ) / self.scale - 0.5
+	# Draw the latest chessboard found on the given camera image, and return True if found
+	def Draw( self, camera, display ) :
+		found, size, corners = self.detections[ camera ]
+		if found : cv2.drawChessboardCorners( display, size, corners, found )
+		return found
+	# Thread main loop
+	def run( self ) :
+		while self.running :
+			# Get the latest images
+			images = self.buffer.Get( 0.1 )
+			if images is None : continue
+			# Find the chessboard on both images
+			start = time.monotonic()
+			self.detections = [ self.Detect( image ) for image in images ]
+			self.detected += 1
+			# Throttle the detection rate
+			delay = start + self.interval - time.monotonic()
+			if delay > 0 : time.sleep( delay )
+
+# Find the chessboard corners on a calibration image
+def FindChessboard( filename, pattern_size, scale = image_scale ) :
+	# Load the image
+	image = cv2.imread( filename, cv2.IMREAD_GRAYSCALE )
+	img_size = ( image.shape[1], image.shape[0] )
+	# Chessboard detection flags
+	flags  = 0
+	flags |= cv2.CALIB_CB_ADAPTIVE_THRESH
+	flags |= cv2.CALIB_CB_NORMALIZE_IMAGE
+	# Find the chessboard corners on a downscaled image
+	found = False
+	if scale < 1.0 :
+		image_small = cv2.resize( image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA )
+		found, corners = cv2.findChessboardCorners( image_small, pattern_size, flags=flags )
+	#	found, corners = cv2.findCirclesGridDefault( image_small, pattern_size, flags = cv2.CALIB_CB_ASYMMETRIC_GRID )
+		# Rescale the corner positions to the full resolution image
+		if found : corners = ( corners + 0.5 ) / scale - 0.5
+	# Fall back to the full resolution image
+	if not found :
+		found, corners = cv2.findChessboardCorners( image, pattern_size, flags=flags )
+	# Pattern not found
+	if not found : return False, None, img_size
+	# Termination criteria
+	criteria = ( cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 30, 1e-5 )
+	# Refine the corner positions on the full resolution image
+	cv2.cornerSubPix( image, corners, (11, 11), (-1, -1), criteria )
+	# Return the corner positions and the image size
+	return True, corners.reshape(-1, 2), img_size
+
+# Find the chessboard corners on a calibration image (process pool task)
+def FindChessboardTask( task ) :
+	return FindChessboard( *task )
+
+# Find the chessboard corners on both images of a stereo pair (process pool task)
+def FindStereoChessboardTask( task ) :
+	left_file, right_file, pattern_size, scale, left, right = task
+	# Detect the pattern on the left image, if not already known
+	if left is None : left = FindChessboard( left_file, pattern_size, scale )
+	# Skip the right image if the pair is already unusable
+	if not left[0] : return left, right
+	# Detect the pattern on the right image, if not already known
+	if right is None : right = FindChessboard( right_file, pattern_size, scale )
+	return left, right
+
+# Run the detection tasks with a process pool
+# The workers are spawned, as forking a process running the camera and user interface threads is unsafe
+def RunDetectionTasks( function, tasks, processes = None ) :
+	# Nothing to compute
+	if not tasks : return []
+	pool = multiprocessing.get_context( 'spawn' ).Pool( processes )
+	try : return pool.map( function, tasks, chunksize = 1 )
+	finally :
+		pool.close()
+		pool.join()
+
+# Find the chessboard corners on the given images with a process pool
+def FindChessboards( image_files, processes = None, cache = None ) :
+	# Get the previous detections from the cache
+	keys = [ DetectionCacheKey( filename ) for filename in image_files ] if cache is not None else []
+	detections = [ cache.get( key ) for key in keys ] if cache is not None else [ None ] * len( image_files )
+	# Detect the pattern on the new images
+	todo = [ i for i, detection in enumerate( detections ) if detection is None ]
+	tasks = [ ( image_files[i], pattern_size, image_scale ) for i in todo ]
+	for i, detection in zip( todo, RunDetectionTasks( FindChessboardTask, tasks, processes ) ) :
+		detections[i] = detection
+		if cache is not None : cache[ keys[i] ] = detection
+	return detections
+
+# Find the chessboard corners on the given stereo pairs with a process pool
+def FindStereoChessboards( left_files, right_files, processes = None, cache = None ) :
+	# Get the previous detections from the cache
+	if cache is not None :
+		left_keys = [ DetectionCacheKey( filename ) for filename in left_files ]
+		right_keys = [ DetectionCacheKey( filename ) for filename in right_files ]
+		detections = [ ( cache.get( left ), cache.get( right ) ) for left, right in zip( left_keys, right_keys ) ]
+	else : detections = [ ( None, None ) ] * len( left_files )
+	# Detect the pattern on the pairs not fully known
+	todo = [ i for i, ( left, right ) in enumerate( detections )
+		if left is None or ( left[0] and right is None ) ]
+	tasks = [ ( left_files[i], right_files[i], pattern_size, image_scale ) + detections[i] for i in todo ]
+	for i, detection in zip( todo, RunDetectionTasks( FindStereoChessboardTask, tasks, processes ) ) :
+		detections[i] = detection
+		if cache is None : continue
+		cache[ left_keys[i] ] = detection[0]
+		if detection[1] is not None : cache[ right_keys[i] ] = detection[1]
+	return detections
+
+# Project the object points of all the views at once
+def ProjectPoints( obj_points, rvecs, tvecs, camera_matrix, dist_coefs ) :
+	# Cast the input data
+	obj_points = np.asarray( obj_points, dtype=np.float64 )
+	rvecs = np.asarray( rvecs, dtype=np.float64 ).reshape(-1, 3)
+	tvecs = np.asarray( tvecs, dtype=np.float64 ).reshape(-1, 3)
+	dist_coefs = np.ravel( dist_coefs )
+	# Thin prism and tilted sensor models are left to OpenCV (the rational model returns them as zeros)
+	if np.any( dist_coefs[8:] ) :
+		return np.array( [ cv2.projectPoints( obj, r, t, camera_matrix, dist_coefs )[0].reshape(-1, 2)
+			for obj, r, t in zip( obj_points, rvecs, tvecs ) ] )
+	# Distortion coefficients ( k1, k2, p1, p2, k3, k4, k5, k6 )
+	k = np.zeros( 8 )
+	k[:min( len( dist_coefs ), 8 )] = dist_coefs[:8]
+	# Rotation matrices (Rodrigues formula)
+	theta = np.sqrt( ( rvecs ** 2 ).sum( axis=1 ) )
+	axis = rvecs / np.where( theta > 0, theta, 1.0 )[:, None]
+	cross = np.zeros( ( len( rvecs ), 3, 3 ) )
+	cross[:,0,1], cross[:,0,2], cross[:,1,2] = -axis[:,2], axis[:,1], -axis[:,0]
+	cross[:,1,0], cross[:,2,0], cross[:,2,1] = axis[:,2], -axis[:,1], axis[:,0]
+	c, s = np.cos( theta )[:, None, None], np.sin( theta )[:, None, None]
+	R = c * np.identity( 3 ) + ( 1 - c ) * axis[:, :, None] * axis[:, None, :] + s * cross
+	# Transform the points in the camera coordinate systems
+	points = np.einsum( 'vij,vnj->vni', R, obj_points ) + tvecs[:, None, :]
+	x = points[..., 0] / points[..., 2]
+	y = points[..., 1] / points[..., 2]
+	# Apply the lens distortion
+	r2 = x * x + y * y
+	radial = ( 1 + r2 * ( k[0] + r2 * ( k[1] + r2 * k[4] ) ) ) / ( 1 + r2 * ( k[5] + r2 * ( k[6] + r2 * k[7] ) ) )
+	xd = x * radial + 2 * k[2] * x * y + k[3] * ( r2 + 2 * x * x )
+	yd = y * radial + k[2] * ( r2 + 2 * y * y ) + 2 * k[3] * x * y
+	# Apply the camera matrix
+	u = camera_matrix[0,0] * xd + camera_matrix[0,1] * yd + camera_matrix[0,2]
+	v = camera_matrix[1,1] * yd + camera_matrix[1,2]
+	return np.stack( ( u, v ), axis=-1 )
+
+# Compute the reprojection error of every corner of every view
+def ReprojectionErrors( calibration, obj_points, img_points ) :
+	# Reproject the object points using the camera parameters
+	reprojected_img_points = ProjectPoints( obj_points, calibration['rvecs'], calibration['tvecs'],
+		calibration['camera_matrix'], calibration['dist_coefs'] )
+	# Distance with the original image points
+	return np.sqrt( ( ( reprojected_img_points - np.asarray( img_points ) ) ** 2 ).sum( axis=-1 ) )
+
+# Compute the epipolar error of every corner of every stereo view
+def EpipolarErrors( calibration, img_points_l, img_points_r ) :
+	# Undistort the image points
+	undistorted_l = cv2.undistortPoints( np.asarray( img_points_l, dtype=np.float32 ).reshape(-1, 1, 2),
+		calibration['camera_matrix_l'], calibration['dist_coefs_l'], P=calibration['camera_matrix_l'] )
+	undistorted_r = cv2.undistortPoints( np.asarray( img_points_r, dtype=np.float32 ).reshape(-1, 1, 2),
+		calibration['camera_matrix_r'], calibration['dist_coefs_r'], P=calibration['camera_matrix_r'] )
+	# Epipolar lines in the other image
+	lines_l = cv2.computeCorrespondEpilines( undistorted_l, 1, calibration['F'] ).reshape(-1, 3)
+	lines_r = cv2.computeCorrespondEpilines( undistorted_r, 2, calibration['F'] ).reshape(-1, 3)
+	undistorted_l, undistorted_r = undistorted_l.reshape(-1, 2), undistorted_r.reshape(-1, 2)
+	# Distance of the points to the corresponding epipolar lines
+	errors = np.abs( ( undistorted_l * lines_r[:, :2] ).sum( axis=1 ) + lines_r[:, 2] )
+	errors += np.abs( ( undistorted_r * lines_l[:, :2] ).sum( axis=1 ) + lines_l[:, 2] )
+	return errors.reshape( np.shape( img_points_l )[:2] )
 
 # Camera calibration
-def CameraCalibration( image_files ) :
+def CameraCalibration( image_files, detections = None, max_error = None, min_views = 10 ) :
 	# Chessboard pattern
 	pattern_points = np.zeros( (np.prod(pattern_size), 3), np.float32 )
 	pattern_points[:,:2] = np.indices(pattern_size).T.reshape(-1, 2)
@@ -62,47 +421,27 @@ def CameraCalibration( image_files ) :
 #		for j in xrange( pattern_size[0] ) :
 #			pattern_points.append( [ (2*j) + i%2 , i, 0 ] )
 #	pattern_points = np.asarray( pattern_points, dtype=np.float32 )
-	# Get image size
-	height, width = cv2.imread( image_files[0] ).shape[:2]
-#	img_size = tuple( cv2.pyrDown( cv2.imread( image_files[0] ), cv2.CV_LOAD_IMAGE_GRAYSCALE ).shape[:2] )
-	img_size = ( width, height )
+	# Find the chessboard corners on the images
+	if detections is None : detections = FindChessboards( image_files, detection_processes )
 	# 3D points
 	obj_points = []
-	# 2D points
+	# 2D points
 	img_points = []
 	# Images with chessboard found
 	img_files = []
-	# For each image
-	for filename in image_files :
-		# Load the image
-		image = cv2.imread( filename, cv2.IMREAD_GRAYSCALE )
-		# Resize image
-	#	image_small = cv2.resize( image, None, fx=image_scale, fy=image_scale )
-	#	image_small = cv2.pyrDown( image )
-	#	image = image_small
-		image_small = image
-		# Chessboard detection flags
-		flags  = 0
-		flags |= cv2.CALIB_CB_ADAPTIVE_THRESH
-		flags |= cv2.CALIB_CB_NORMALIZE_IMAGE
-		# Find the chessboard corners on the image
-		found, corners = cv2.findChessboardCorners( image_small, pattern_size, flags=flags )
-	#	found, corners = cv2.findCirclesGridDefault( image, pattern_size, flags = cv2.CALIB_CB_ASYMMETRIC_GRID )
-		# Pattern not found
+	# For each image
+	for filename, ( found, corners, size ) in zip( image_files, detections ) :
+		# Pattern not found
 		if not found :
 			print( 'Pattern not found on image {}...'.format( filename ) )
 			continue
-		# Rescale the corner position
-	#	corners *= 1.0 / image_scale
-	#	corners *= 2.0
-		# Termination criteria
-		criteria = ( cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 30, 1e-5 )
-		# Refine the corner positions
-		cv2.cornerSubPix( image, corners, (11, 11), (-1, -1), criteria )
-		# Store image and corner informations
-		img_points.append( corners.reshape(-1, 2) )
+		# Store image and corner informations
+		img_points.append( corners )
 		obj_points.append( pattern_points )
 		img_files.append( filename )
+		img_size = size
+	# Nothing to calibrate
+	if not img_points : raise ValueError( 'Cannot calibrate the camera, the pattern is not found on any image' )
 	# Camera calibration flags
 	flags  = 0
 #	flags |= cv2.CALIB_USE_INTRINSIC_GUESS
@@ -113,22 +452,24 @@ def CameraCalibration( image_files ) :
 #	flags |= cv2.CALIB_FIX_K3
 	flags |= cv2.CALIB_FIX_K4
 	flags |= cv2.CALIB_FIX_K5
-	# Camera calibration
-	calibration = cv2.calibrateCamera( obj_points, img_points, img_size, None, None, flags=flags )
-	# Store the calibration results in a dictionary
-	parameter_names = ( 'calib_error', 'camera_matrix', 'dist_coefs', 'rvecs', 'tvecs' )
-	calibration = dict( zip( parameter_names, calibration ) )
-	# Compute reprojection error
-	calibration['reproject_error'] = 0
-	for i, obj in enumerate( obj_points ) :
-		# Reproject the object points using the camera parameters
-		reprojected_img_points, _ = cv2.projectPoints( obj, calibration['rvecs'][i],
-		calibration['tvecs'][i], calibration['camera_matrix'], calibration['dist_coefs'] )
-		# Compute the error with the original image points
-		error = cv2.norm( img_points[i], reprojected_img_points.reshape(-1, 2), cv2.NORM_L2 )
-		# Add to the total error
-		calibration['reproject_error'] += error * error
-	calibration['reproject_error'] = math.sqrt( calibration['reproject_error'] / (len(obj_points) * np.prod(pattern_size)) )
+	# Calibrate, and discard the worst view until the error target is met
+	while True :
+		# Camera calibration
+		calibration = cv2.calibrateCamera( obj_points, img_points, img_size, None, None, flags=flags )
+		# Store the calibration results in a dictionary
+		parameter_names = ( 'calib_error', 'camera_matrix', 'dist_coefs', 'rvecs', 'tvecs' )
+		calibration = dict( zip( parameter_names, calibration ) )
+		# Compute reprojection error
+		errors = ReprojectionErrors( calibration, obj_points, img_points )
+		calibration['corner_errors'] = errors
+		calibration['view_errors'] = np.sqrt( ( errors ** 2 ).mean( axis=1 ) )
+		calibration['reproject_error'] = math.sqrt( ( errors ** 2 ).mean() )
+		# Error target met
+		if max_error is None or calibration['reproject_error'] <= max_error or len( obj_points ) <= min_views : break
+		# Discard the worst view
+		worst = int( np.argmax( calibration['view_errors'] ) )
+		print( 'Discard image {} (error {})...'.format( img_files[worst], calibration['view_errors'][worst] ) )
+		del obj_points[worst], img_points[worst], img_files[worst]
 	# Backup calibration parameters for future use
 	calibration['img_points'] = img_points
 	calibration['obj_points'] = obj_points
@@ -139,11 +480,22 @@ def CameraCalibration( image_files ) :
 	return calibration
 
 # Stereo camera calibration
-def StereoCameraCalibration() :
-	# Calibrate the left camera
-	cam1 = CameraCalibration( sorted( glob.glob( '{}/left*.png'.format(calibration_directory) ) ) )
-	# Calibrate the right camera
-	cam2 = CameraCalibration( sorted( glob.glob( '{}/right*.png'.format(calibration_directory) ) ) )
+def StereoCameraCalibration( max_error = None, min_views = 10 ) :
+	# Pair the left and right calibration images
+	left_files, right_files = [], []
+	for left_file in sorted( glob.glob( '{}/left*.png'.format(calibration_directory) ) ) :
+		right_file = '{}/right{}'.format( calibration_directory, os.path.basename( left_file )[4:] )
+		if not os.path.isfile( right_file ) : continue
+		left_files.append( left_file )
+		right_files.append( right_file )
+	# Find the chessboard on both images of each pair, reusing the previous detections
+	cache = LoadDetectionCache()
+	detections = FindStereoChessboards( left_files, right_files, detection_processes, cache )
+	SaveDetectionCache( cache )
+	# Keep only the pairs with the chessboard found on both images
+	pairs = [ i for i, ( left, right ) in enumerate( detections ) if left[0] and right and right[0] ]
+	for i in sorted( set( range( len( detections ) ) ) - set( pairs ) ) :
+		print( 'Pattern not found on image pair {} / {}...'.format( left_files[i], right_files[i] ) )
 	# Stereo calibration termination criteria
 	criteria = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 100, 1e-5)
 	# Stereo calibration flags
@@ -159,13 +511,32 @@ def StereoCameraCalibration() :
 	flags |= cv2.CALIB_FIX_K3
 	flags |= cv2.CALIB_FIX_K4
 	flags |= cv2.CALIB_FIX_K5
-	# Stereo calibration
-	calibration = cv2.stereoCalibrate( cam1['obj_points'], cam1['img_points'], cam2['img_points'],
-		cam1['camera_matrix'], cam1['dist_coefs'], cam2['camera_matrix'], cam2['dist_coefs'], cam1['img_size'],
-		flags=flags, criteria=criteria )
-	# Store the stereo calibration results in a dictionary
-	parameter_names = ( 'calib_error', 'camera_matrix_l', 'dist_coefs_l', 'camera_matrix_r', 'dist_coefs_r', 'R', 'T', 'E', 'F' )
-	calibration = dict( zip( parameter_names, calibration ) )
+	# Calibrate, and discard the worst pair until the error target is met
+	while True :
+		# Calibrate the left camera
+		cam1 = CameraCalibration( [ left_files[i] for i in pairs ], [ detections[i][0] for i in pairs ] )
+		# Calibrate the right camera
+		cam2 = CameraCalibration( [ right_files[i] for i in pairs ], [ detections[i][1] for i in pairs ] )
+		# Stereo calibration
+		calibration = cv2.stereoCalibrate( cam1['obj_points'], cam1['img_points'], cam2['img_points'],
+			cam1['camera_matrix'], cam1['dist_coefs'], cam2['camera_matrix'], cam2['dist_coefs'], cam1['img_size'],
+			flags=flags, criteria=criteria )
+		# Store the stereo calibration results in a dictionary
+		parameter_names = ( 'calib_error', 'camera_matrix_l', 'dist_coefs_l', 'camera_matrix_r', 'dist_coefs_r', 'R', 'T', 'E', 'F' )
+		calibration = dict( zip( parameter_names, calibration ) )
+		# Compute reprojection error
+		errors = EpipolarErrors( calibration, cam1['img_points'], cam2['img_points'] )
+		calibration['corner_errors'] = errors
+		calibration['view_errors'] = errors.mean( axis=1 )
+		calibration['reproject_error'] = errors.mean()
+		calibration['img_files'] = list( zip( cam1['img_files'], cam2['img_files'] ) )
+		# Error target met
+		pair_errors = np.maximum( np.maximum( cam1['view_errors'], cam2['view_errors'] ), calibration['view_errors'] )
+		if max_error is None or pair_errors.max() <= max_error or len( pairs ) <= min_views : break
+		# Discard the worst pair
+		worst = int( np.argmax( pair_errors ) )
+		print( 'Discard image pair {} / {} (error {})...'.format( left_files[pairs[worst]], right_files[pairs[worst]], pair_errors[worst] ) )
+		del pairs[worst]
 	# Stereo rectification
 	rectification = cv2.stereoRectify(
 		calibration['camera_matrix_l'], calibration['dist_coefs_l'],
@@ -174,26 +545,9 @@ def StereoCameraCalibration() :
 	# Store the stereo rectification results in the dictionary
 	parameter_names = ( 'R1', 'R2', 'P1', 'P2', 'Q', 'ROI1', 'ROI2' )
 	calibration.update( zip( parameter_names, rectification ) )
-	# Undistortion maps
-	calibration['left_map'] = cv2.initUndistortRectifyMap(
-		calibration['camera_matrix_l'], calibration['dist_coefs_l'],
-		calibration['R1'], calibration['P1'], cam1['img_size'], cv2.CV_32FC1 )
-	calibration['right_map'] = cv2.initUndistortRectifyMap(
-		calibration['camera_matrix_r'], calibration['dist_coefs_r'],
-		calibration['R2'], calibration['P2'], cam2['img_size'], cv2.CV_32FC1 )
-	# Compute reprojection error
-	undistorted_l = cv2.undistortPoints( np.concatenate( cam1['img_points'] ).reshape(-1, 1, 2),
-		calibration['camera_matrix_l'], calibration['dist_coefs_l'], P=calibration['camera_matrix_l'] )
-	undistorted_r = cv2.undistortPoints( np.concatenate( cam2['img_points'] ).reshape(-1, 1, 2),
-		calibration['camera_matrix_r'], calibration['dist_coefs_r'], P=calibration['camera_matrix_r'] )
-	lines_l = cv2.computeCorrespondEpilines( undistorted_l, 1, calibration['F'] )
-	lines_r = cv2.computeCorrespondEpilines( undistorted_r, 2, calibration['F'] )
-	calibration['reproject_error'] = 0
-	for i in range( len( undistorted_l ) ) :
-		calibration['reproject_error'] += abs( undistorted_l[i][0][0] * lines_r[i][0][0] +
-			undistorted_l[i][0][1] * lines_r[i][0][1] + lines_r[i][0][2] ) + abs( undistorted_r[i][0][0] * lines_l[i][0][0] +
-			undistorted_r[i][0][1] * lines_l[i][0][1] + lines_l[i][0][2] )
-	calibration['reproject_error'] /= len( undistorted_r )
+	# Undistortion maps (fixed-point)
+	calibration['img_size'] = cam1['img_size']
+	calibration['left_map'], calibration['right_map'] = RectificationMaps( calibration )
 	# Write calibration results
 	with open( '{}/calibration.log'.format(calibration_directory) , 'w') as output_file :
 		output_file.write( '\n~~~ Left camera calibration ~~~\n\n' )
@@ -224,22 +578,35 @@ def StereoCameraCalibration() :
 		output_file.write( 'Disparity-to-depth mapping matrix :\n{}\n'.format( calibration['Q'] ) )
 		output_file.write( 'ROI for the left camera :  {}\n'.format( calibration['ROI1'] ) )
 		output_file.write( 'ROI for the right camera : {}\n'.format( calibration['ROI2'] ) )
+		output_file.write( '\n~~~ Per-view errors (left / right / epipolar) ~~~\n\n' )
+		for i, ( left_file, right_file ) in enumerate( calibration['img_files'] ) :
+			output_file.write( '{} / {} : {:.4f} / {:.4f} / {:.4f}\n'.format( left_file, right_file,
+				cam1['view_errors'][i], cam2['view_errors'][i], calibration['view_errors'][i] ) )
 	# Write the calibration object with all the parameters
-	with open( '{}/calibration.pkl'.format(calibration_directory) , 'wb') as output_file :
-		pickle.dump( calibration, output_file, pickle.HIGHEST_PROTOCOL )
-	# Return the calibration
-	return calibration
+	SaveCalibration( calibration )
+	# Return the calibration
+	return StereoCalibration( calibration )
 
 # Stereo image undistortion
-def StereoRectification( calibration, left_image, right_image, display = False ) :
-	# Remap the images
-	left_image = cv2.remap( left_image, calibration['left_map'][0], calibration['left_map'][1], cv2.INTER_LINEAR )
-	right_image = cv2.remap( right_image, calibration['right_map'][0], calibration['right_map'][1], cv2.INTER_LINEAR )
+def StereoRectification( calibration, left_image, right_image, display = False, crop = False ) :
+	# Rectification maps
+	left_map, right_map = calibration['left_map'], calibration['right_map']
+	# Only remap the region valid on both rectified images
+	x0, y0 = 0, 0
+	if crop :
+		x0, y0, x1, y1 = RectificationROI( calibration )
+		left_map = [ m[ y0:y1, x0:x1 ] for m in left_map ]
+		right_map = [ m[ y0:y1, x0:x1 ] for m in right_map ]
+	# Remap the images (fast path with the fixed-point maps)
+	left_image = cv2.remap( left_image, left_map[0], left_map[1], cv2.INTER_LINEAR )
+	right_image = cv2.remap( right_image, right_map[0], right_map[1], cv2.INTER_LINEAR )
 	# Display the rectified images
 	if display :
 		# Print ROI
-		cv2.rectangle( left_image, calibration['ROI1'][:2], calibration['ROI1'][2:], (0,0,255), 2 )
-		cv2.rectangle( right_image, calibration['ROI2'][:2], calibration['ROI2'][2:], (0,0,255), 2 )
+		x, y, w, h = calibration['ROI1']
+		cv2.rectangle( left_image, (x - x0, y - y0), (x - x0 + w - 1, y - y0 + h - 1), (0,0,255), 2 )
+		x, y, w, h = calibration['ROI2']
+		cv2.rectangle( right_image, (x - x0, y - y0), (x - x0 + w - 1, y - y0 + h - 1), (0,0,255), 2 )
 		# Print lines
 		for i in range( 0, left_image.shape[0], 32 ) :
 			cv2.line( left_image, (0, i), (left_image.shape[1], i), (0, 255, 0), 2 )
@@ -1,53 +1,184 @@
 # -*- coding:utf-8 -*-
 
 #
-# Module to capture images from USB cameras
+# Module to capture images from stereo frame sources (USB cameras)
 #
 
 # External dependencies
+import math
 import threading
+import time
 import cv2
 
-# Thread to read the images from two USB cameras
-class UsbStereoCamera( threading.Thread ) :
+# Running statistics of a measure (Welford algorithm)
+class RunningStatistics( object ) :
 	# Initialisation
 	def __init__( self ) :
+		self.count = 0
+		self.mean = 0.0
+		self.sum_squares = 0.0
+		self.minimum = float( 'inf' )
+		self.maximum = float( '-inf' )
+	# Add a new value
+	def Add( self, value ) :
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.sum_squares += delta * ( value - self.mean )
+		self.minimum = min( self.minimum, value )
+		self.maximum = max( self.maximum, value )
+	# Return the standard deviation
+	@property
+	def deviation( self ) :
+		return math.sqrt( self.sum_squares / self.count ) if self.count else 0.0
+
+# Stereo image pair with its capture timestamps
+class StereoFrame( object ) :
+	# Initialisation
+	def __init__( self, index, image_left, image_right, timestamps, positions = ( None, None ) ) :
+		# Frame number
+		self.index = index
+		# Images
+		self.image_left = image_left
+		self.image_right = image_right
+		# Monotonic timestamps (seconds) before grabbing, and after each grab and retrieve
+		self.grab_start, self.grab_left, self.grab_right, self.retrieve_left, self.retrieve_right = timestamps
+		# Camera timestamps (milliseconds), if provided by the driver
+		self.position_left, self.position_right = positions
+		# Synchronization state, set by the pairing policy
+		self.synchronized = True
+	# Return the time difference between the left and right images (seconds)
+	@property
+	def skew( self ) :
+		# Use the camera timestamps if available
+		if self.position_left and self.position_right :
+			return abs( self.position_left - self.position_right ) / 1000.0
+		# Otherwise use the grab timestamps
+		return abs( self.grab_right - self.grab_left )
+	# Return the time between the start of the capture and the retrieval of both images (seconds)
+	@property
+	def latency( self ) :
+		return max( self.retrieve_left, self.retrieve_right ) - self.grab_start
+
+# Policy to reject or flag the stereo pairs badly synchronized
+class StereoPairing( object ) :
+	# Initialisation
+	def __init__( self, max_skew = 0.015, drop = False ) :
+		# Maximum time difference between the left and right images (seconds, no check if None)
+		self.max_skew = max_skew
+		# Drop the pairs above the threshold, or only flag them (free-running cameras are rarely within the threshold)
+		self.drop = drop
+		# Pair counters
+		self.accepted = 0
+		self.rejected = 0
+		# Skew and latency statistics
+		self.skew = RunningStatistics()
+		self.latency = RunningStatistics()
+	# Check the synchronization of a stereo pair, and return True if it must be processed
+	def Check( self, frame ) :
+		# Update the statistics
+		self.skew.Add( frame.skew )
+		self.latency.Add( frame.latency )
+		# Check the time difference
+		frame.synchronized = self.max_skew is None or frame.skew <= self.max_skew
+		if frame.synchronized : self.accepted += 1
+		else : self.rejected += 1
+		# Drop or flag the pair
+		return frame.synchronized or not self.drop
+
+# Thread to read stereo frames from a source, and send them to a callback function
+class StereoFrameSource( threading.Thread ) :
+	# Initialisation
+	def __init__( self, pairing = None ) :
 		# Initialize the thread
-		super( UsbStereoCamera, self ).__init__()
-		# Initialize the cameras
-		self.camera_left = cv2.VideoCapture( 0 )
-		self.camera_right = cv2.VideoCapture( 1 )
+		super( StereoFrameSource, self ).__init__()
+		self.daemon = True
+		# Stereo pair synchronization policy
+		self.pairing = pairing if pairing else StereoPairing()
 	# Return the image width
 	@property
 	def width( self ) :
-		return self.camera_left.get( cv2.CAP_PROP_FRAME_WIDTH )
+		raise NotImplementedError
 	# Return the image height
 	@property
 	def height( self ) :
-		return self.camera_left.get( cv2.CAP_PROP_FRAME_HEIGHT )
-	# Start acquisition
+		raise NotImplementedError
+	# Read the next stereo frame, or return None at the end of the source
+	def ReadFrame( self, index ) :
+		raise NotImplementedError
+	# Release the source
+	def Release( self ) :
+		pass
+	# Start acquisition
 	def StartCapture( self, image_callback ) :
 		# Function called when the images are received
 		self.image_callback = image_callback
-		# Start the capture loop
+		# Start the capture loop
 		self.running = True
 		self.start()
-	# Stop acquisition
+	# Stop acquisition
 	def StopCapture( self ) :
 		self.running = False
 		self.join()
 	# Thread main loop
 	def run( self ) :
+		# Frame number
+		index = 0
 		# Thread running
 		while self.running :
-			# Capture images
-			self.camera_left.grab()
-			self.camera_right.grab()
-			# Get the images
-			_, image_left = self.camera_left.retrieve()
-			_, image_right = self.camera_right.retrieve()
-			# Send the image via the external callback function
-			self.image_callback( image_left, image_right )
-		# Release the cameras
+			# Read the next frame
+			frame = self.ReadFrame( index )
+			if frame is None : break
+			index += 1
+			# Send the frame via the external callback function, if correctly synchronized
+			if self.pairing.Check( frame ) : self.image_callback( frame )
+		# Release the source
+		self.Release()
+
+# Thread to read the images from two USB cameras
+class UsbStereoCamera( StereoFrameSource ) :
+	# Initialisation
+	def __init__( self, left = 0, right = 1, width = None, height = None, fps = None, pairing = None ) :
+		# Initialize the thread
+		super( UsbStereoCamera, self ).__init__( pairing )
+		# Initialize the cameras
+		self.camera_left = cv2.VideoCapture( left )
+		self.camera_right = cv2.VideoCapture( right )
+		# Set the camera frame rate and resolution
+		for camera in ( self.camera_left, self.camera_right ) :
+			if width : camera.set( cv2.CAP_PROP_FRAME_WIDTH, width )
+			if height : camera.set( cv2.CAP_PROP_FRAME_HEIGHT, height )
+			if fps : camera.set( cv2.CAP_PROP_FPS, fps )
+	# Return the image width
+	@property
+	def width( self ) :
+		return self.camera_left.get( cv2.CAP_PROP_FRAME_WIDTH )
+	# Return the image height
+	@property
+	def height( self ) :
+		return self.camera_left.get( cv2.CAP_PROP_FRAME_HEIGHT )
+	# Return the camera timestamp (milliseconds), if available
+	def Position( self, camera ) :
+		position = camera.get( cv2.CAP_PROP_POS_MSEC )
+		return position if position > 0 else None
+	# Capture the images from the cameras
+	def ReadFrame( self, index ) :
+		# Capture images
+		grab_start = time.monotonic()
+		self.camera_left.grab()
+		grab_left = time.monotonic()
+		self.camera_right.grab()
+		grab_right = time.monotonic()
+		# Get the images
+		_, image_left = self.camera_left.retrieve()
+		retrieve_left = time.monotonic()
+		_, image_right = self.camera_right.retrieve()
+		retrieve_right = time.monotonic()
+		# Create the stereo frame
+		return StereoFrame( index, image_left, image_right,
+			( grab_start, grab_left, grab_right, retrieve_left, retrieve_right ),
+			( self.Position( self.camera_left ), self.Position( self.camera_right ) ) )
+	# Release the cameras
+	def Release( self ) :
 		self.camera_left.release()
 		self.camera_right.release()
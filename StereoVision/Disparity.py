@@ -5,16 +5,19 @@
 #
 
 # External dependencies
+import json
+import queue
+import threading
 import cv2
 import numpy as np
 from PySide import QtCore
 from PySide import QtGui
+from .Matcher import StereoMatcher, matcher_backends, confidence_threshold
 
-# Export the point cloud to a PLY file
-def WritePly( filename, coordinates, colors ) :
-	ply_header = (
+# PLY header
+ply_header = (
 '''ply
-format ascii 1.0
+format {format} 1.0
 element vertex {vertex_count}
 property float x
 property float y
@@ -24,18 +27,99 @@ property uchar green
 property uchar blue
 end_header
 ''' )
+
+# Vertex layout of the PLY file (packed, little-endian)
+ply_vertex = np.dtype( [ ( 'x', '<f4' ), ( 'y', '<f4' ), ( 'z', '<f4' ), ( 'red', 'u1' ), ( 'green', 'u1' ), ( 'blue', 'u1' ) ] )
+
+# Export the point cloud to a PLY file (binary little-endian, or ASCII), optionally filtered
+def WritePly( filename, coordinates, colors, binary = True, point_filter = None ) :
 	coordinates = coordinates.reshape(-1, 3)
 	colors = colors.reshape(-1, 3)
-	mask = coordinates[:, 2] > coordinates[:, 2].min()+10
-	coordinates = coordinates[ mask ]
-	colors = colors[ mask ]
-	mask = coordinates[:, 2] < coordinates[:, 2].max()-10
-	coordinates = coordinates[ mask ]
-	colors = colors[ mask ]
-	points = np.hstack( [ coordinates, colors ] )
-	with open( filename, 'w' ) as output_file :
-		output_file.write( ply_header.format( vertex_count=len(coordinates) ) )
-		np.savetxt( output_file, points, '%f %f %f %d %d %d' )
+	if point_filter : coordinates, colors = point_filter.Apply( coordinates, colors )
+	# Fill the vertex buffer (colors given as floats are in the range [0, 1])
+	points = np.empty( len( coordinates ), ply_vertex )
+	points['x'], points['y'], points['z'] = coordinates.T
+	if colors.dtype.kind == 'f' : colors = np.clip( colors * 255 + 0.5, 0, 255 )
+	points['red'], points['green'], points['blue'] = colors.T
+	# Write the file
+	with open( filename, 'wb' ) as output_file :
+		output_file.write( ply_header.format( format = 'binary_little_endian' if binary else 'ascii', vertex_count = len( points ) ).encode( 'ascii' ) )
+		if binary : points.tofile( output_file )
+		else : np.savetxt( output_file, points, '%f %f %f %d %d %d' )
+
+# Thread pool to export the point clouds in the background
+class PlyWriter( object ) :
+	# Initialisation
+	def __init__( self, threads = 2, binary = True, point_filter = None ) :
+		# File format
+		self.binary = binary
+		# Point cloud filter applied before the export
+		self.point_filter = point_filter
+		# Point clouds waiting to be written
+		self.queue = queue.Queue()
+		# Number of point clouds written, and failed
+		self.written = 0
+		self.failed = 0
+		# Start the writer threads
+		self.threads = [ threading.Thread( target = self.Run ) for _ in range( threads ) ]
+		for thread in self.threads :
+			thread.daemon = True
+			thread.start()
+	# Number of point clouds waiting to be written
+	def __len__( self ) :
+		return self.queue.qsize()
+	# Add a point cloud to write (the arrays must not be modified afterwards)
+	def Put( self, filename, coordinates, colors ) :
+		self.queue.put( ( filename, coordinates, colors ) )
+	# Write the pending point clouds, and stop the threads
+	def Close( self ) :
+		for _ in self.threads : self.queue.put( None )
+		for thread in self.threads : thread.join()
+	# Thread main loop
+	def Run( self ) :
+		while True :
+			# Get the next point cloud
+			task = self.queue.get()
+			if task is None : break
+			# Write the point cloud
+			try :
+				WritePly( *task, binary = self.binary, point_filter = self.point_filter )
+				self.written += 1
+				print( 'Point cloud {} saved...'.format( task[0] ) )
+			except Exception as error :
+				self.failed += 1
+				print( 'Cannot save the point cloud {} ({})...'.format( task[0], error ) )
+
+# Colormap of the disparity maps for display, over the fixed disparity range of the matcher
+# The disparities are mapped to the indices of a 256-entry table of 32-bit BGRX colors,
+# which is looked up straight into the display image (the disparity map is left unchanged)
+class DisparityColormap( object ) :
+	# Initialisation
+	def __init__( self, min_disparity = 0, num_disparities = 16, colormap = None ) :
+		# Linear mapping of the disparity range to the table indices (the invalid disparities, below the range, saturate to 0)
+		self.alpha = 255.0 / num_disparities
+		self.beta = -min_disparity * self.alpha
+		# Color table : gray levels by default, or an OpenCV colormap (cv2.COLORMAP_JET...), with black invalid disparities
+		ramp = np.arange( 256, dtype=np.uint8 ).reshape( 256, 1 )
+		colors = cv2.applyColorMap( ramp, colormap ) if colormap is not None else cv2.cvtColor( ramp, cv2.COLOR_GRAY2BGR )
+		colors[0] = 0
+		self.lut = cv2.cvtColor( colors, cv2.COLOR_BGR2BGRA ).view( np.uint32 ).ravel()
+		# Index images reused across frames
+		self.indices = None
+		self.display_indices = None
+	# Draw the disparity map in the given 32-bit BGRX display image
+	def Apply( self, disparity, display ) :
+		# Table indices of the disparities (single saturating pass)
+		self.indices = cv2.addWeighted( disparity, self.alpha, disparity, 0.0, self.beta, self.indices, cv2.CV_8U )
+		indices = self.indices
+		# Upscale the indices to the display resolution (nearest neighbor, so only the table colors are displayed)
+		height, width = display.shape[:2]
+		if indices.shape != ( height, width ) :
+			self.display_indices = cv2.resize( indices, ( width, height ), self.display_indices, interpolation = cv2.INTER_NEAREST )
+			indices = self.display_indices
+		# Look up the colors into the display image
+		np.take( self.lut, indices, out = display.view( np.uint32 )[..., 0], mode = 'clip' )
+		return display
 
 # Customize the Qt widget to setup the stereo BM
 class StereoSGBM( QtGui.QWidget ) :
@@ -54,6 +138,10 @@ class StereoSGBM( QtGui.QWidget ) :
 		self.p2 = 32 * 3 * self.sad_window_size ** 2
 		self.max_difference = 1
 		self.full_dp = False
+		self.backend = 'sgbm'
+		self.bands = 1
+		self.coarse_levels = 0
+		self.lr_tolerance = 0.0
 		# Set the window title
 		self.setWindowTitle( 'StereoSGBM' )
 		# Widget elements
@@ -78,17 +166,39 @@ class StereoSGBM( QtGui.QWidget ) :
 		self.spinbox_speckle_range = QtGui.QSpinBox( self )
 		self.spinbox_speckle_range.setValue( self.speckle_range )
 		self.spinbox_p1 = QtGui.QSpinBox( self )
-		self.spinbox_p1.setMaximum( 2000 )
+		self.spinbox_p1.setMaximum( 100000 )
 		self.spinbox_p1.setValue( self.p1 )
 		self.spinbox_p2 = QtGui.QSpinBox( self )
-		self.spinbox_p2.setMaximum( 2000 )
+		self.spinbox_p2.setMaximum( 100000 )
 		self.spinbox_p2.setValue( self.p2 )
 		self.spinbox_max_difference = QtGui.QSpinBox( self )
 		self.spinbox_max_difference.setValue( self.max_difference )
+		self.spinbox_bands = QtGui.QSpinBox( self )
+		self.spinbox_bands.setMinimum( 1 )
+		self.spinbox_bands.setMaximum( 16 )
+		self.spinbox_bands.setValue( self.bands )
+		self.spinbox_coarse_levels = QtGui.QSpinBox( self )
+		self.spinbox_coarse_levels.setMaximum( 3 )
+		self.spinbox_coarse_levels.setValue( self.coarse_levels )
+		self.spinbox_lr_tolerance = QtGui.QDoubleSpinBox( self )
+		self.spinbox_lr_tolerance.setMaximum( 16 )
+		self.spinbox_lr_tolerance.setSingleStep( 0.5 )
+		self.spinbox_lr_tolerance.setSpecialValueText( 'Off' )
+		self.spinbox_lr_tolerance.setValue( self.lr_tolerance )
 		self.checkbox_full_dp = QtGui.QCheckBox( self )
 		if self.full_dp : self.checkbox_full_dp.setCheckState( True )
+		self.checkbox_full_dp.toggled.connect( self.ToggleFullDP )
+		self.combobox_backend = QtGui.QComboBox( self )
+		for index, name in enumerate( sorted( matcher_backends ) ) :
+			backend = matcher_backends[ name ]
+			self.combobox_backend.addItem( name )
+			self.combobox_backend.setItemData( index, '{} - time x{relative_time}, memory {memory}'.format( backend.description, **backend.cost_profile ), QtCore.Qt.ToolTipRole )
+		self.combobox_backend.setCurrentIndex( self.combobox_backend.findText( self.backend ) )
+		self.combobox_backend.currentIndexChanged.connect( self.SelectBackend )
 		self.button_apply = QtGui.QPushButton( 'Apply', self )
 		self.button_apply.clicked.connect( self.UpdateDisparity )
+		self.button_tuning = QtGui.QPushButton( 'Load tuning', self )
+		self.button_tuning.clicked.connect( self.LoadTuning )
 		# Widget layout
 		self.layout_controls = QtGui.QFormLayout()
 		self.layout_controls.addRow( 'Minimum disparity', self.spinbox_min_disparity )
@@ -100,10 +210,15 @@ class StereoSGBM( QtGui.QWidget ) :
 		self.layout_controls.addRow( 'P1', self.spinbox_p1 )
 		self.layout_controls.addRow( 'P2', self.spinbox_p2 )
 		self.layout_controls.addRow( 'Maximum difference', self.spinbox_max_difference )
+		self.layout_controls.addRow( 'Matcher', self.combobox_backend )
 		self.layout_controls.addRow( 'Full scale DP', self.checkbox_full_dp )
+		self.layout_controls.addRow( 'Parallel bands', self.spinbox_bands )
+		self.layout_controls.addRow( 'Coarse-to-fine levels', self.spinbox_coarse_levels )
+		self.layout_controls.addRow( 'Left-right tolerance', self.spinbox_lr_tolerance )
 		self.layout_global = QtGui.QVBoxLayout( self )
 		self.layout_global.addLayout( self.layout_controls )
 		self.layout_global.addWidget( self.button_apply )
+		self.layout_global.addWidget( self.button_tuning )
 		self.layout_global.setSizeConstraint( QtGui.QLayout.SetFixedSize )
 		# Set the Escape key to close the application
 		QtGui.QShortcut( QtGui.QKeySequence( QtCore.Qt.Key_Escape ), self ).activated.connect( self.close )
@@ -121,30 +236,69 @@ class StereoSGBM( QtGui.QWidget ) :
 		self.max_difference = self.spinbox_max_difference.value()
 		self.p1 = self.spinbox_p1.value()
 		self.p2 = self.spinbox_p2.value()
-		self.full_dp = self.checkbox_full_dp.checkState()
-		# Create the disparity object
-		self.sgbm = cv2.StereoSGBM_create( minDisparity = self.min_disparity,
-			numDisparities = self.max_disparity,
-			blockSize = 16,
-			uniquenessRatio = self.uniqueness_ratio,
-			speckleWindowSize = self.speckle_window_size,
-			speckleRange = self.speckle_range,
-			disp12MaxDiff = self.max_difference,
-			P1 = self.p1,
-			P2 = self.p2 )
-	# Compute the stereo correspondence
+		self.full_dp = self.checkbox_full_dp.isChecked()
+		self.backend = self.combobox_backend.currentText()
+		self.bands = self.spinbox_bands.value()
+		self.coarse_levels = self.spinbox_coarse_levels.value()
+		self.lr_tolerance = self.spinbox_lr_tolerance.value()
+		# Create the disparity object
+		self.matcher = StereoMatcher( min_disparity = self.min_disparity,
+			max_disparity = self.max_disparity,
+			block_size = self.sad_window_size,
+			uniqueness_ratio = self.uniqueness_ratio,
+			speckle_window_size = self.speckle_window_size,
+			speckle_range = self.speckle_range,
+			max_difference = self.max_difference,
+			p1 = self.p1,
+			p2 = self.p2,
+			backend = self.backend,
+			bands = self.bands,
+			coarse_levels = self.coarse_levels,
+			lr_tolerance = self.lr_tolerance )
+		# Colormap of the disparity range
+		self.colormap = DisparityColormap( self.min_disparity, self.max_disparity )
+	# Apply the given matching parameters (from the autotuner) to the controls, and create the disparity object
+	def ApplyParameters( self, parameters ) :
+		controls = { 'min_disparity' : self.spinbox_min_disparity, 'max_disparity' : self.spinbox_max_disparity,
+			'block_size' : self.spinbox_sad_window_size, 'uniqueness_ratio' : self.spinbox_uniqueness_ratio,
+			'speckle_window_size' : self.spinbox_speckle_window_size, 'speckle_range' : self.spinbox_speckle_range,
+			'p1' : self.spinbox_p1, 'p2' : self.spinbox_p2, 'max_difference' : self.spinbox_max_difference,
+			'bands' : self.spinbox_bands, 'coarse_levels' : self.spinbox_coarse_levels, 'lr_tolerance' : self.spinbox_lr_tolerance }
+		for name, value in parameters.items() :
+			if name in controls : controls[ name ].setValue( value )
+		if 'backend' in parameters : self.combobox_backend.setCurrentIndex( self.combobox_backend.findText( parameters['backend'] ) )
+		self.UpdateDisparity()
+	# Full scale DP selects the 8-direction semi-global matching
+	def ToggleFullDP( self, checked ) :
+		if checked : self.combobox_backend.setCurrentIndex( self.combobox_backend.findText( 'hh' ) )
+		elif self.combobox_backend.currentText() == 'hh' : self.combobox_backend.setCurrentIndex( self.combobox_backend.findText( 'sgbm' ) )
+	# Keep the full scale DP checkbox consistent with the selected backend
+	def SelectBackend( self, _ ) :
+		self.checkbox_full_dp.setChecked( self.combobox_backend.currentText() == 'hh' )
+	# Choose a configuration on the Pareto front of an autotuning report, and apply it
+	def LoadTuning( self ) :
+		filename, _ = QtGui.QFileDialog.getOpenFileName( self, 'Load tuning', '.', 'Autotuning report (*.json)' )
+		if not filename : return
+		with open( filename ) as report_file : pareto = json.load( report_file )['pareto']
+		if not pareto : return
+		from .Autotune import TuningSummary
+		summaries = [ TuningSummary( result ) for result in pareto ]
+		summary, accepted = QtGui.QInputDialog.getItem( self, 'Load tuning', 'Configuration :', summaries, 0, False )
+		if accepted : self.ApplyParameters( pareto[ summaries.index( summary ) ]['parameters'] )
+	# Return the current matching parameters
+	@property
+	def parameters( self ) :
+		return dict( self.matcher.parameters )
+	# Compute the stereo correspondence
 	def ComputeDisparity( self, left_image, right_image ) :
-		# Compute the disparity map
-		self.disparity = self.sgbm.compute( left_image, right_image ).astype( np.float32 ) / 16.0
+		# Compute the disparity map, and its left-right consistency confidence if enabled
+		self.disparity, self.confidence = self.matcher.ComputeWithConfidence( left_image, right_image )
+		# Mask of the confident disparities (None without left-right check)
+		self.valid = self.confidence >= confidence_threshold if self.confidence is not None else None
 	#	self.disparity[0:50,:] = 0
 	#	self.disparity[210:240,:] = 0
 	#	self.disparity[:,0:70] = 0
 	#	self.disparity[:,250:320] = 0
-		# Create the disparity image for display
-		self.disparity_image = self.disparity
-		cv2.normalize( self.disparity_image, self.disparity_image, 0, 255, cv2.NORM_MINMAX )
-#		self.disparity_image = ( self.disparity - self.disparity.min() ) / ( self.disparity.max() - self.disparity.min() )
-		self.disparity_image = self.disparity_image.astype( np.uint8 )
-		self.disparity_image = cv2.cvtColor( self.disparity_image, cv2.COLOR_GRAY2RGB )
-#		self.disparity_image = cv2.applyColorMap( self.disparity_image, cv2.COLORMAP_JET )
-#		self.disparity_image = cv2.cvtColor( self.disparity_image, cv2.COLOR_BGR2RGB )
+	# Draw the latest disparity map in the given display image
+	def DrawDisparity( self, display ) :
+		return self.colormap.Apply( self.disparity, display )
@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to filter the point clouds
+#
+
+# External dependencies
+import numpy as np
+
+# Default point cloud filter parameters (0 disables the corresponding filter)
+filter_parameters = {
+	'min_depth' : 0.0,
+	'max_depth' : 0.0,
+	'voxel_size' : 0.0,
+	'outlier_radius' : 0.0,
+	'min_neighbors' : 4,
+}
+
+# Number of bits of each voxel index in the voxel keys
+voxel_key_bits = 21
+
+# Offsets of the 27 neighbor voxels in the voxel key space
+voxel_neighbors = np.array( [ ( dx << ( 2 * voxel_key_bits ) ) + ( dy << voxel_key_bits ) + dz
+	for dx in ( -1, 0, 1 ) for dy in ( -1, 0, 1 ) for dz in ( -1, 0, 1 ) ], dtype=np.int64 )
+
+# Compute the hashed integer key of the voxel containing each point
+# The voxel indices are packed in a 64-bit integer (21 bits per axis, centered on the origin)
+def VoxelKeys( coordinates, voxel_size ) :
+	indices = np.floor( coordinates / voxel_size ).astype( np.int64 )
+	indices += 1 << ( voxel_key_bits - 1 )
+	np.clip( indices, 1, ( 1 << voxel_key_bits ) - 2, out = indices )
+	return ( indices[:, 0] << ( 2 * voxel_key_bits ) ) | ( indices[:, 1] << voxel_key_bits ) | indices[:, 2]
+
+# Keep the points within the given depth range
+def DepthClip( coordinates, colors, min_depth = 0.0, max_depth = 0.0 ) :
+	mask = coordinates[:, 2] > min_depth
+	if max_depth : mask &= coordinates[:, 2] < max_depth
+	return coordinates[ mask ], colors[ mask ]
+
+# Replace the points of each voxel by their centroid and their mean color
+def VoxelDownsample( coordinates, colors, voxel_size ) :
+	# Group the points by voxel
+	keys, inverse, counts = np.unique( VoxelKeys( coordinates, voxel_size ), return_inverse = True, return_counts = True )
+	# Average the coordinates and the colors of each voxel
+	voxel_coordinates = np.empty( ( len( keys ), 3 ), np.float32 )
+	voxel_colors = np.empty( ( len( keys ), 3 ), np.float32 )
+	for i in range( 3 ) :
+		voxel_coordinates[:, i] = np.bincount( inverse, coordinates[:, i], len( keys ) ) / counts
+		voxel_colors[:, i] = np.bincount( inverse, colors[:, i], len( keys ) ) / counts
+	# Keep the color type (8-bit colors are rounded)
+	if colors.dtype.kind != 'f' : voxel_colors = voxel_colors.round().astype( colors.dtype )
+	return voxel_coordinates, voxel_colors
+
+# Remove the isolated points, with less than the given number of neighbors
+# The neighbors are counted in a grid of radius-sized cells (the 27 cells around each point),
+# so the neighborhood is a cube between one and two radius wide rather than an exact sphere
+def RadiusOutlierRemoval( coordinates, colors, radius, min_neighbors = 4 ) :
+	# Spatial grid index : sorted cell keys and number of points per cell
+	keys = VoxelKeys( coordinates, radius )
+	cells, counts = np.unique( keys, return_counts = True )
+	# Count the points in the neighbor cells of each point
+	neighbors = np.full( len( keys ), -1, np.int64 )
+	for offset in voxel_neighbors :
+		neighbor_keys = keys + offset
+		index = np.searchsorted( cells, neighbor_keys )
+		index[ index == len( cells ) ] = 0
+		neighbors += np.where( cells[ index ] == neighbor_keys, counts[ index ], 0 )
+	# Keep the points with enough neighbors
+	mask = neighbors >= min_neighbors
+	return coordinates[ mask ], colors[ mask ]
+
+# Point cloud filter chain : depth clipping, outlier removal, and voxel downsampling
+class PointCloudFilter( object ) :
+	# Initialisation
+	def __init__( self, **parameters ) :
+		# Initialize the parameters with the default values
+		self.parameters = dict( filter_parameters )
+		self.SetParameters( **parameters )
+	# Update the parameters
+	def SetParameters( self, **parameters ) :
+		self.parameters.update( parameters )
+	# Filter the given point cloud
+	def Apply( self, coordinates, colors ) :
+		coordinates, colors = coordinates.reshape( -1, 3 ), colors.reshape( -1, 3 )
+		# Depth range
+		coordinates, colors = DepthClip( coordinates, colors, self.parameters['min_depth'], self.parameters['max_depth'] )
+		# Isolated points
+		if self.parameters['outlier_radius'] and len( coordinates ) :
+			coordinates, colors = RadiusOutlierRemoval( coordinates, colors, self.parameters['outlier_radius'], self.parameters['min_neighbors'] )
+		# Point density
+		if self.parameters['voxel_size'] and len( coordinates ) :
+			coordinates, colors = VoxelDownsample( coordinates, colors, self.parameters['voxel_size'] )
+		return coordinates, colors
@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to fuse the point clouds of successive frames
+#
+
+# External dependencies
+import numpy as np
+from .Filter import VoxelKeys
+
+# Empty slot of the voxel hash table
+empty_key = -1
+
+# Multiplier of the Fibonacci hashing of the voxel keys
+hash_multiplier = np.uint64( 0x9E3779B97F4A7C15 )
+
+# Sparse voxel map, with the running mean position and color of the points observed in each voxel
+# The voxels are stored in arrays with spare capacity, indexed by an open addressing hash table of their integer key,
+# so each frame is merged with vectorized lookups and appends, at a cost that depends on the frame and not on the map size
+class VoxelMap( object ) :
+	# Initialisation
+	def __init__( self, voxel_size = 0.1, max_voxels = 1000000, min_observations = 2, capacity = 65536, eviction_ratio = 0.1 ) :
+		# Voxel size (calibration units)
+		self.voxel_size = voxel_size
+		# Memory cap, in number of voxels
+		self.max_voxels = max_voxels
+		# Number of observations of a reliable voxel
+		self.min_observations = min_observations
+		# Initial number of voxels allocated
+		self.capacity = min( capacity, max_voxels )
+		# Fraction of the map evicted at once when the cap is reached, so the hash table is rebuilt rarely
+		self.eviction_ratio = eviction_ratio
+		# Empty map
+		self.Clear()
+	# Remove all the voxels
+	def Clear( self ) :
+		# Number of voxels in the map
+		self.size = 0
+		# Voxel arrays (only the first size elements are used)
+		self.keys = np.empty( self.capacity, np.int64 )
+		self.positions = np.empty( ( self.capacity, 3 ), np.float32 )
+		self.colors = np.empty( ( self.capacity, 3 ), np.float32 )
+		self.counts = np.empty( self.capacity, np.int32 )
+		self.last_seen = np.empty( self.capacity, np.int32 )
+		# Hash table, at most half full
+		self.AllocateTable()
+		# Number of frames integrated
+		self.frame = 0
+		# Number of voxels evicted
+		self.evicted = 0
+	# Number of voxels in the map
+	def __len__( self ) :
+		return self.size
+	# Memory used by the map (bytes)
+	@property
+	def nbytes( self ) :
+		return sum( array.nbytes for array in ( self.keys, self.positions, self.colors, self.counts, self.last_seen, self.table_keys, self.table_voxels ) )
+	# Allocate an empty hash table (a power of two with at least twice the slots of the voxel arrays)
+	def AllocateTable( self ) :
+		self.table_bits = ( 2 * len( self.keys ) - 1 ).bit_length()
+		self.table_keys = np.full( 1 << self.table_bits, empty_key, np.int64 )
+		self.table_voxels = np.empty( 1 << self.table_bits, np.int32 )
+	# Rebuild the hash table from the voxel arrays
+	def Rehash( self ) :
+		self.AllocateTable()
+		keys = self.keys[ : self.size ]
+		self.Insert( keys, np.arange( self.size, dtype = np.int32 ), self.Find( keys ) )
+	# Find the table slot of each key, or the empty slot where it has to be inserted (linear probing)
+	def Find( self, keys ) :
+		mask = len( self.table_keys ) - 1
+		slots = ( ( keys.astype( np.uint64 ) * hash_multiplier ) >> np.uint64( 64 - self.table_bits ) ).astype( np.int64 )
+		pending = np.arange( len( keys ) )
+		while len( pending ) :
+			table_keys = self.table_keys[ slots[ pending ] ]
+			pending = pending[ ( table_keys != keys[ pending ] ) & ( table_keys != empty_key ) ]
+			slots[ pending ] = ( slots[ pending ] + 1 ) & mask
+		return slots
+	# Insert new keys with their voxel index, starting from their empty slot
+	def Insert( self, keys, voxels, slots ) :
+		mask = len( self.table_keys ) - 1
+		while len( keys ) :
+			# One key per empty slot
+			_, first = np.unique( slots, return_index = True )
+			self.table_keys[ slots[ first ] ] = keys[ first ]
+			self.table_voxels[ slots[ first ] ] = voxels[ first ]
+			# The other keys move to their next empty slot
+			rest = np.ones( len( keys ), dtype=bool )
+			rest[ first ] = False
+			keys, voxels, slots = keys[ rest ], voxels[ rest ], ( slots[ rest ] + 1 ) & mask
+			occupied = self.table_keys[ slots ] != empty_key
+			while occupied.any() :
+				slots[ occupied ] = ( slots[ occupied ] + 1 ) & mask
+				occupied = self.table_keys[ slots ] != empty_key
+	# Make room for the given number of voxels (the capacity is doubled, so the appends are amortized)
+	def Reserve( self, size ) :
+		if size <= len( self.keys ) : return
+		capacity = min( max( 2 * len( self.keys ), size ), self.max_voxels )
+		for name in ( 'keys', 'positions', 'colors', 'counts', 'last_seen' ) :
+			array = getattr( self, name )
+			resized = np.empty( ( capacity, ) + array.shape[1:], array.dtype )
+			resized[ : self.size ] = array[ : self.size ]
+			setattr( self, name, resized )
+		self.Rehash()
+	# Integrate the point cloud of a new frame (optionally moved to the map coordinates with a 4x4 camera pose)
+	def Integrate( self, coordinates, colors, pose = None ) :
+		self.frame += 1
+		coordinates, colors = coordinates.reshape( -1, 3 ), colors.reshape( -1, 3 )
+		if not len( coordinates ) : return
+		# Map coordinates
+		if pose is not None : coordinates = np.dot( coordinates, pose[:3, :3].T ) + pose[:3, 3]
+		# Reduce the frame to its voxels (sums of the positions and colors, and number of points)
+		keys, inverse, counts = np.unique( VoxelKeys( coordinates, self.voxel_size ), return_inverse = True, return_counts = True )
+		positions = np.empty( ( len( keys ), 3 ), np.float32 )
+		frame_colors = np.empty( ( len( keys ), 3 ), np.float32 )
+		for i in range( 3 ) :
+			positions[:, i] = np.bincount( inverse, coordinates[:, i], len( keys ) ) / counts
+			frame_colors[:, i] = np.bincount( inverse, colors[:, i], len( keys ) ) / counts
+		# Find the voxels already in the map
+		slots = self.Find( keys )
+		found = self.table_keys[ slots ] == keys
+		# Update the running means of the observed voxels (each frame counts as one observation)
+		updated = self.table_voxels[ slots[ found ] ]
+		weights = ( 1.0 / ( self.counts[ updated ] + 1 ) )[:, None]
+		self.positions[ updated ] += ( positions[ found ] - self.positions[ updated ] ) * weights
+		self.colors[ updated ] += ( frame_colors[ found ] - self.colors[ updated ] ) * weights
+		self.counts[ updated ] += 1
+		self.last_seen[ updated ] = self.frame
+		# New voxels (at most the memory cap)
+		new = np.flatnonzero( ~found )[ : self.max_voxels ]
+		if not len( new ) : return
+		# Respect the memory cap, by evicting a batch of voxels
+		if self.size + len( new ) > self.max_voxels :
+			self.Evict( min( max( self.size + len( new ) - self.max_voxels, int( self.max_voxels * self.eviction_ratio ) ), self.size ) )
+		self.Reserve( self.size + len( new ) )
+		# Append the new voxels, and index them
+		start, end = self.size, self.size + len( new )
+		self.keys[ start : end ] = keys[ new ]
+		self.positions[ start : end ] = positions[ new ]
+		self.colors[ start : end ] = frame_colors[ new ]
+		self.counts[ start : end ] = 1
+		self.last_seen[ start : end ] = self.frame
+		self.Insert( keys[ new ], np.arange( start, end, dtype = np.int32 ), self.Find( keys[ new ] ) )
+		self.size = end
+	# Remove the given number of voxels, the weakly observed ones first, then the oldest ones
+	def Evict( self, count ) :
+		if count <= 0 : return
+		# Eviction priority (the reliable voxels are kept longer than all the others)
+		priority = self.last_seen[ : self.size ].astype( np.int64 )
+		priority[ self.counts[ : self.size ] >= self.min_observations ] += self.frame + 1
+		# Remove the voxels with the lowest priority, and compact the arrays
+		evicted = np.argpartition( priority, count - 1 )[:count]
+		keep = np.ones( self.size, dtype=bool )
+		keep[ evicted ] = False
+		size = self.size - count
+		for array in ( self.keys, self.positions, self.colors, self.counts, self.last_seen ) :
+			array[ : size ] = array[ : self.size ][ keep ]
+		self.size = size
+		self.evicted += count
+		# Index the remaining voxels
+		self.Rehash()
+	# Return the point cloud of the map (one point per voxel observed enough), for the viewer or the PLY export
+	def PointCloud( self, min_observations = None ) :
+		mask = self.counts[ : self.size ] >= ( self.min_observations if min_observations is None else min_observations )
+		return self.positions[ : self.size ][ mask ], np.clip( self.colors[ : self.size ][ mask ] + 0.5, 0, 255 ).astype( np.uint8 )
@@ -0,0 +1,332 @@
+# -*- coding:utf-8 -*-
+
+#
+# Stereo matching module
+#
+
+# External dependencies
+import concurrent.futures
+import cv2
+import numpy as np
+
+# Default stereo matching parameters
+matcher_parameters = {
+	'backend' : 'sgbm',
+	'min_disparity' : 0,
+	'max_disparity' : 16,
+	'block_size' : 16,
+	'uniqueness_ratio' : 10,
+	'speckle_window_size' : 100,
+	'speckle_range' : 32,
+	'p1' : 8 * 3 * 3 ** 2,
+	'p2' : 32 * 3 * 3 ** 2,
+	'max_difference' : 1,
+	'lr_tolerance' : 0.0,
+	'bands' : 1,
+	'band_margin' : 32,
+	'coarse_levels' : 0,
+	'coarse_margin' : 4,
+}
+
+# Convert a color image to grayscale
+def GrayImage( image ) :
+	return cv2.cvtColor( image, cv2.COLOR_BGR2GRAY ) if image.ndim == 3 else image
+
+# Stereo matcher backend interface
+# The backends compute the disparity in fixed-point (1/16 pixel, 16-bit), like the OpenCV matchers,
+# with the invalid disparities set to ( min_disparity - 1 ) * 16
+class MatcherBackend( object ) :
+	# Cost profile : time relative to SGBM on the same images, memory footprint, and internal parallelism
+	cost_profile = {}
+	# Description of the backend
+	description = ''
+	# Matching parameters without effect on the backend
+	ignored_parameters = ()
+	# Initialisation
+	def __init__( self, parameters ) :
+		self.parameters = parameters
+	# Return the block size actually used for the given block size parameter
+	@staticmethod
+	def BlockSize( block_size ) :
+		return block_size
+	# Change the disparity search range
+	def SetDisparityRange( self, min_disparity, num_disparities ) :
+		raise NotImplementedError
+	# Return the minimum disparity
+	def MinDisparity( self ) :
+		raise NotImplementedError
+	# Compute the fixed-point disparity map of the given rectified images
+	def Compute( self, left_image, right_image ) :
+		raise NotImplementedError
+
+# OpenCV stereo matchers
+class OpenCVBackend( MatcherBackend ) :
+	# Change the disparity search range
+	def SetDisparityRange( self, min_disparity, num_disparities ) :
+		self.matcher.setMinDisparity( min_disparity )
+		self.matcher.setNumDisparities( num_disparities )
+	# Return the minimum disparity
+	def MinDisparity( self ) :
+		return self.matcher.getMinDisparity()
+	# Compute the fixed-point disparity map of the given rectified images
+	def Compute( self, left_image, right_image ) :
+		return self.matcher.compute( left_image, right_image )
+
+# OpenCV block matcher (fast path, grayscale images, no smoothness constraint)
+class BMBackend( OpenCVBackend ) :
+	cost_profile = { 'relative_time' : 0.2, 'memory' : 'O(W.D)', 'threads' : True }
+	description = 'Block matching (fast, grayscale)'
+	ignored_parameters = ( 'p1', 'p2' )
+	# Initialisation
+	def __init__( self, parameters ) :
+		super( BMBackend, self ).__init__( parameters )
+		self.matcher = cv2.StereoBM_create( parameters['max_disparity'], self.BlockSize( parameters['block_size'] ) )
+		self.matcher.setMinDisparity( parameters['min_disparity'] )
+		self.matcher.setUniquenessRatio( parameters['uniqueness_ratio'] )
+		self.matcher.setSpeckleWindowSize( parameters['speckle_window_size'] )
+		self.matcher.setSpeckleRange( parameters['speckle_range'] )
+		self.matcher.setDisp12MaxDiff( parameters['max_difference'] )
+	# Compute the fixed-point disparity map of the given rectified images
+	def Compute( self, left_image, right_image ) :
+		return self.matcher.compute( GrayImage( left_image ), GrayImage( right_image ) )
+	# Return the block size actually used (odd, and at least 5)
+	@staticmethod
+	def BlockSize( block_size ) :
+		return max( 5, block_size | 1 )
+
+# OpenCV semi-global block matcher
+class SGBMBackend( OpenCVBackend ) :
+	cost_profile = { 'relative_time' : 1.0, 'memory' : 'O(W.D)', 'threads' : False }
+	description = 'Semi-global matching, 5 directions'
+	mode = cv2.StereoSGBM_MODE_SGBM
+	# Initialisation
+	def __init__( self, parameters ) :
+		super( SGBMBackend, self ).__init__( parameters )
+		self.matcher = cv2.StereoSGBM_create( minDisparity = parameters['min_disparity'],
+			numDisparities = parameters['max_disparity'],
+			blockSize = parameters['block_size'],
+			uniquenessRatio = parameters['uniqueness_ratio'],
+			speckleWindowSize = parameters['speckle_window_size'],
+			speckleRange = parameters['speckle_range'],
+			disp12MaxDiff = parameters['max_difference'],
+			P1 = parameters['p1'],
+			P2 = parameters['p2'],
+			mode = self.mode )
+
+# OpenCV semi-global block matcher, full-scale two-pass dynamic programming
+class HHBackend( SGBMBackend ) :
+	cost_profile = { 'relative_time' : 2.5, 'memory' : 'O(W.H.D)', 'threads' : False }
+	description = 'Semi-global matching, 8 directions (full scale DP)'
+	mode = cv2.StereoSGBM_MODE_HH
+
+# OpenCV semi-global block matcher, 3 directions
+class SGBM3WayBackend( SGBMBackend ) :
+	cost_profile = { 'relative_time' : 0.6, 'memory' : 'O(W.D)', 'threads' : True }
+	description = 'Semi-global matching, 3 directions (parallel)'
+	mode = cv2.StereoSGBM_MODE_SGBM_3WAY
+
+# OpenCV semi-global block matcher, 4 directions
+class HH4Backend( SGBMBackend ) :
+	cost_profile = { 'relative_time' : 0.8, 'memory' : 'O(W.D)', 'threads' : True }
+	description = 'Semi-global matching, 4 directions (parallel)'
+	mode = cv2.StereoSGBM_MODE_HH4
+
+# Pure NumPy winner-takes-all block matcher (sum of absolute differences), as a reference for testing
+# Only the disparity range, the block size, and the uniqueness ratio are used
+class NumpyBackend( MatcherBackend ) :
+	cost_profile = { 'relative_time' : 20.0, 'memory' : 'O(W.H.D)', 'threads' : False }
+	description = 'Reference block matching (NumPy, slow)'
+	# Initialisation
+	def __init__( self, parameters ) :
+		super( NumpyBackend, self ).__init__( parameters )
+		self.min_disparity, self.num_disparities = parameters['min_disparity'], parameters['max_disparity']
+	# Change the disparity search range
+	def SetDisparityRange( self, min_disparity, num_disparities ) :
+		self.min_disparity, self.num_disparities = min_disparity, num_disparities
+	# Return the minimum disparity
+	def MinDisparity( self ) :
+		return self.min_disparity
+	# Compute the fixed-point disparity map of the given rectified images
+	def Compute( self, left_image, right_image ) :
+		left_image = GrayImage( left_image ).astype( np.float32 )
+		right_image = GrayImage( right_image ).astype( np.float32 )
+		height, width = left_image.shape
+		radius = self.parameters['block_size'] // 2
+		# Block boundaries, clipped to the image
+		y0, y1 = np.clip( np.arange( height ) - radius, 0, height ), np.clip( np.arange( height ) + radius + 1, 0, height )
+		x0, x1 = np.clip( np.arange( width ) - radius, 0, width ), np.clip( np.arange( width ) + radius + 1, 0, width )
+		area = ( ( y1 - y0 )[:, None] * ( x1 - x0 )[None, :] ).astype( np.float32 )
+		# Mean absolute difference of the blocks for each disparity (the pixels without correspondence have the maximum cost)
+		disparities = np.arange( self.min_disparity, self.min_disparity + self.num_disparities )
+		costs = np.empty( ( len( disparities ), height, width ), np.float32 )
+		difference = np.empty( ( height, width ), np.float32 )
+		integral = np.zeros( ( height + 1, width + 1 ), np.float64 )
+		for i, d in enumerate( disparities ) :
+			difference[:] = 255.0
+			if 0 <= d < width : difference[:, d:] = np.abs( left_image[:, d:] - right_image[:, :width - d] )
+			elif -width < d < 0 : difference[:, :d] = np.abs( left_image[:, :d] - right_image[:, -d:] )
+			integral[1:, 1:] = difference.cumsum( axis = 0 ).cumsum( axis = 1 )
+			costs[i] = ( integral[ y1 ][:, x1 ] - integral[ y0 ][:, x1 ] - integral[ y1 ][:, x0 ] + integral[ y0 ][:, x0 ] ) / area
+		# Winner takes all
+		best = costs.argmin( axis = 0 )
+		best_cost = np.take_along_axis( costs, best[None], axis = 0 )[0]
+		# Uniqueness : the best cost must be lower than the other costs (except the adjacent disparities) by the given ratio
+		index = np.arange( len( disparities ) )[:, None, None]
+		second_cost = np.where( np.abs( index - best[None] ) > 1, costs, np.inf ).min( axis = 0 )
+		unique = second_cost * 100 >= best_cost * ( 100 + self.parameters['uniqueness_ratio'] )
+		# Fixed-point disparity, with the invalid value of the OpenCV matchers
+		disparity = ( disparities[ best ] * 16 ).astype( np.int16 )
+		disparity[ ~unique ] = ( self.min_disparity - 1 ) * 16
+		disparity[:, :max( self.min_disparity + self.num_disparities - 1, 0 ) ] = ( self.min_disparity - 1 ) * 16
+		return disparity
+
+# Stereo matcher backends
+matcher_backends = {
+	'bm' : BMBackend,
+	'sgbm' : SGBMBackend,
+	'hh' : HHBackend,
+	'sgbm_3way' : SGBM3WayBackend,
+	'hh4' : HH4Backend,
+	'numpy' : NumpyBackend,
+}
+
+# Create the stereo matcher backend
+def CreateMatcherBackend( parameters ) :
+	return matcher_backends[ parameters['backend'] ]( parameters )
+
+# Create the stereo matcher backend of a coarse pyramid level
+def CreateCoarseMatcherBackend( parameters ) :
+	scale = 2 ** parameters['coarse_levels']
+	coarse_parameters = dict( parameters )
+	coarse_parameters['min_disparity'] = parameters['min_disparity'] // scale
+	coarse_parameters['max_disparity'] = max( 16, -( -parameters['max_disparity'] // ( 16 * scale ) ) * 16 )
+	coarse_parameters['block_size'] = max( 3, ( parameters['block_size'] // scale ) | 1 )
+	return CreateMatcherBackend( coarse_parameters )
+
+# Compute the disparity map of the right image, by matching the horizontally flipped images
+def ComputeRightDisparity( matcher, left_image, right_image ) :
+	return matcher.Compute( cv2.flip( right_image, 1 ), cv2.flip( left_image, 1 ) )[:, ::-1]
+
+# Minimum confidence of the disparities kept by the downstream stages
+confidence_threshold = 0.5
+
+# Compute the difference between each left disparity and the right disparity of its corresponding pixel
+# The difference is infinite for the invalid disparities, and for the pixels without correspondence
+def LeftRightDifference( left_disparity, right_disparity, min_disparity = 0 ) :
+	height, width = left_disparity.shape
+	# Corresponding pixel in the right image
+	x = np.arange( width, dtype=np.float32 ) - left_disparity
+	x_right = np.clip( np.rint( x ), 0, width - 1 ).astype( np.intp )
+	# Disparity of the corresponding pixel
+	disparity = np.take_along_axis( right_disparity, x_right, axis = 1 )
+	threshold = max( min_disparity - 1, 0 )
+	difference = np.abs( left_disparity - disparity )
+	difference[ ( left_disparity <= threshold ) | ( disparity <= threshold ) | ( x < 0 ) ] = np.inf
+	return difference
+
+# Check the consistency of the left and right disparity maps
+# Return the mask of the valid left disparities whose corresponding right disparity differs by less than the tolerance
+def LeftRightConsistency( left_disparity, right_disparity, min_disparity = 0, tolerance = 1.0 ) :
+	return LeftRightDifference( left_disparity, right_disparity, min_disparity ) <= tolerance
+
+# Compute the confidence of each left disparity, from 1 for identical left and right disparities to 0 for a difference
+# of twice the tolerance or more (the confidence threshold 0.5 corresponds to the tolerance)
+def LeftRightConfidence( left_disparity, right_disparity, min_disparity = 0, tolerance = 1.0 ) :
+	confidence = LeftRightDifference( left_disparity, right_disparity, min_disparity )
+	confidence *= -0.5 / tolerance
+	confidence += 1.0
+	return np.clip( confidence, 0.0, 1.0, out = confidence )
+
+# Split the image rows in bands, and extend each band with a margin
+def ImageBands( height, bands, margin ) :
+	bounds = np.linspace( 0, height, bands + 1 ).astype( int )
+	return [ ( y0, y1, max( y0 - margin, 0 ), min( y1 + margin, height ) ) for y0, y1 in zip( bounds[:-1], bounds[1:] ) ]
+
+# Stereo matching engine, independent of the user interface, with a selectable backend
+# With several bands, the images are split in horizontal bands matched concurrently, each with its own matcher.
+# The band margin must cover the block size. As SGBM aggregates the matching costs along paths crossing the whole
+# image, the disparities near the band borders are only approximately identical to the single band output,
+# and get closer with a larger margin.
+# With coarse levels, the disparity is first computed on downscaled images, and each band is then matched
+# at full resolution only over the disparity range found in the band at the coarse level (coarse-to-fine).
+class StereoMatcher( object ) :
+	# Initialisation
+	def __init__( self, **parameters ) :
+		# Initialize the parameters with the default values
+		self.parameters = dict( matcher_parameters )
+		# Thread pool for the bands
+		self.pool = None
+		# Create the matcher
+		self.SetParameters( **parameters )
+	# Update the parameters, and create the matcher
+	def SetParameters( self, **parameters ) :
+		self.parameters.update( parameters )
+		self.backend = CreateMatcherBackend( self.parameters )
+		# One matcher per band
+		self.band_matchers = [ self.backend ] + [ CreateMatcherBackend( self.parameters ) for _ in range( self.parameters['bands'] - 1 ) ]
+		# Coarse level matcher
+		self.coarse_backend = CreateCoarseMatcherBackend( self.parameters ) if self.parameters['coarse_levels'] > 0 else None
+		# One thread per band
+		if self.pool : self.pool.shutdown()
+		self.pool = concurrent.futures.ThreadPoolExecutor( self.parameters['bands'] ) if self.parameters['bands'] > 1 else None
+	# Compute the disparity map (in pixels) of the given rectified images
+	def Compute( self, left_image, right_image ) :
+		# Whole images
+		if self.pool is None and self.coarse_backend is None : return self.backend.Compute( left_image, right_image ).astype( np.float32 ) / 16.0
+		# Image bands (with a margin covering at least the block size), and their disparity range
+		bands = ImageBands( left_image.shape[0], self.parameters['bands'], max( self.parameters['band_margin'], self.parameters['block_size'] ) )
+		ranges = self.DisparityRanges( left_image, right_image, bands ) if self.coarse_backend else [ None ] * len( bands )
+		# Match the bands, and stitch them without their margins
+		disparity = np.empty( left_image.shape[:2], np.float32 )
+		def ComputeBand( matcher, band, disparity_range ) :
+			y0, y1, top, bottom = band
+			# Narrow the disparity range of the band
+			if disparity_range : matcher.SetDisparityRange( *disparity_range )
+			band_disparity = matcher.Compute( left_image[ top:bottom ], right_image[ top:bottom ] )[ y0 - top : y1 - top ]
+			disparity[ y0:y1 ] = band_disparity
+			# Use the same invalid disparity value in all the bands
+			if disparity_range : disparity[ y0:y1 ][ band_disparity < disparity_range[0] * 16 ] = ( self.parameters['min_disparity'] - 1 ) * 16
+		# Match the bands concurrently (OpenCV and NumPy release the GIL)
+		if self.pool :
+			for future in [ self.pool.submit( ComputeBand, *task ) for task in zip( self.band_matchers, bands, ranges ) ] :
+				future.result()
+		else :
+			for task in zip( self.band_matchers, bands, ranges ) : ComputeBand( *task )
+		disparity /= 16.0
+		return disparity
+	# Compute the disparity map (in pixels) and its left-right consistency confidence map
+	# Without left-right tolerance, the confidence map is None
+	def ComputeWithConfidence( self, left_image, right_image ) :
+		disparity = self.Compute( left_image, right_image )
+		if not self.parameters['lr_tolerance'] : return disparity, None
+		return disparity, LeftRightConfidence( disparity, ComputeRightDisparity( self, left_image, right_image ),
+			self.parameters['min_disparity'], self.parameters['lr_tolerance'] )
+	# Find the disparity range (minimum, number of disparities) of each band at the coarse level
+	def DisparityRanges( self, left_image, right_image, bands ) :
+		# Coarse disparity
+		scale = 2 ** self.parameters['coarse_levels']
+		for _ in range( self.parameters['coarse_levels'] ) :
+			left_image, right_image = cv2.pyrDown( left_image ), cv2.pyrDown( right_image )
+		coarse_disparity = self.coarse_backend.Compute( left_image, right_image )
+		# Valid coarse disparities (above the fixed-point invalid value), without the left columns outside the search range
+		coarse_min = self.coarse_backend.MinDisparity()
+		valid = coarse_disparity > ( coarse_min - 1 ) * 16
+		valid[ :, : max( coarse_min + self.coarse_backend.parameters['max_disparity'], 0 ) ] = False
+		coarse_disparity = coarse_disparity.astype( np.float32 ) * ( scale / 16.0 )
+		# Full disparity range
+		min_disparity, max_disparity = self.parameters['min_disparity'], self.parameters['min_disparity'] + self.parameters['max_disparity']
+		ranges = []
+		for y0, y1, _, _ in bands :
+			# Coarse disparities of the band
+			band_disparity = coarse_disparity[ y0 // scale : -( -y1 // scale ) ][ valid[ y0 // scale : -( -y1 // scale ) ] ]
+			# Keep the full range without enough coarse disparities
+			if band_disparity.size < 16 :
+				ranges.append( ( min_disparity, self.parameters['max_disparity'] ) )
+				continue
+			# Robust range of the band, with a margin for the coarse level inaccuracy
+			low, high = np.percentile( band_disparity, ( 1, 99 ) )
+			low = max( int( np.floor( low ) ) - self.parameters['coarse_margin'] * scale, min_disparity )
+			high = min( int( np.ceil( high ) ) + self.parameters['coarse_margin'] * scale, max_disparity )
+			# The number of disparities must be a multiple of 16
+			ranges.append( ( low, max( 16, -( -( high - low ) // 16 ) * 16 ) ) )
+		return ranges
@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to process the stereo images in a background thread
+#
+
+# External dependencies
+import collections
+import threading
+import numpy as np
+
+# Bounded ring buffer of frames, where the latest frame wins
+class FrameBuffer( object ) :
+	# Initialisation
+	def __init__( self, size = 1 ) :
+		# Frames waiting to be processed
+		self.frames = collections.deque( maxlen = size )
+		# Synchronisation between the producer and the consumer
+		self.condition = threading.Condition()
+		# Number of frames dropped
+		self.dropped = 0
+		# Buffer state
+		self.closed = False
+	# Number of frames in the buffer
+	def __len__( self ) :
+		return len( self.frames )
+	# Add a frame, and drop the oldest one if the buffer is full
+	def Put( self, frame ) :
+		with self.condition :
+			if len( self.frames ) == self.frames.maxlen : self.dropped += 1
+			self.frames.append( frame )
+			self.condition.notify()
+	# Get the latest frame, and drop the older ones
+	def Get( self, timeout = None ) :
+		with self.condition :
+			# Wait for a frame
+			if not self.frames and not self.closed : self.condition.wait( timeout )
+			# No frame available
+			if not self.frames : return None
+			# Keep only the latest frame
+			self.dropped += len( self.frames ) - 1
+			frame = self.frames.pop()
+			self.frames.clear()
+			return frame
+	# Wake up the consumer, and stop waiting for frames
+	def Close( self ) :
+		with self.condition :
+			self.closed = True
+			self.condition.notify_all()
+
+# Thread to process the frames outside of the acquisition and display threads
+class FrameProcessor( threading.Thread ) :
+	# Initialisation
+	def __init__( self, process_callback, result_callback, buffer_size = 1 ) :
+		# Initialize the thread
+		super( FrameProcessor, self ).__init__()
+		self.daemon = True
+		# Function called to process a frame, and function called when a result is ready
+		self.process_callback = process_callback
+		self.result_callback = result_callback
+		# Frames waiting to be processed
+		self.buffer = FrameBuffer( buffer_size )
+		# Latest result not yet consumed
+		self.result = None
+		self.result_lock = threading.Lock()
+		# Frame counters
+		self.processed = 0
+		self.dropped_results = 0
+		self.failed = 0
+	# Number of frames dropped before processing
+	@property
+	def dropped( self ) :
+		return self.buffer.dropped
+	# Start processing
+	def StartProcessing( self ) :
+		self.running = True
+		self.start()
+	# Stop processing
+	def StopProcessing( self ) :
+		self.running = False
+		self.buffer.Close()
+		self.join()
+	# Send a frame to process (called from the acquisition thread)
+	def Put( self, frame ) :
+		self.buffer.Put( frame )
+	# Get the latest result (called from the display thread)
+	def TakeResult( self ) :
+		with self.result_lock :
+			result, self.result = self.result, None
+		return result
+	# Thread main loop
+	def run( self ) :
+		# Thread running
+		while self.running :
+			# Get the latest frame
+			frame = self.buffer.Get( 0.1 )
+			if frame is None : continue
+			# Process the frame (no result to send if None), and keep running if it fails
+			try : result = self.process_callback( frame )
+			except Exception as error :
+				self.failed += 1
+				print( 'Cannot process the frame ({})...'.format( error ) )
+				continue
+			self.processed += 1
+			if result is None : continue
+			# Replace the previous result if it has not been consumed yet
+			with self.result_lock :
+				pending = self.result is not None
+				if pending : self.dropped_results += 1
+				self.result = result
+			# Notify that a new result is ready
+			if not pending : self.result_callback()
+
+# Pool of display images reused across frames (32-bit BGRX images, directly usable as Qt RGB32 images)
+# The processing thread composes each frame into a buffer that is neither displayed nor the latest composed,
+# so three buffers are enough to never write into an image being painted
+class DisplayBuffers( object ) :
+	# Initialisation
+	def __init__( self, count = 3 ) :
+		# Display images, and number of times each one has been composed
+		self.buffers = [ None ] * count
+		self.generations = [ 0 ] * count
+		# Index of the buffer displayed, and of the latest buffer composed
+		self.displayed = None
+		self.composed = None
+		self.lock = threading.Lock()
+	# Get a free buffer of the given size, and its ticket to display it (called from the processing thread)
+	def Acquire( self, height, width ) :
+		with self.lock :
+			index = next( i for i in range( len( self.buffers ) ) if i not in ( self.displayed, self.composed ) )
+			self.composed = index
+			self.generations[ index ] += 1
+			ticket = ( index, self.generations[ index ] )
+		# Allocate the buffer only when the image size changes
+		if self.buffers[ index ] is None or self.buffers[ index ].shape[:2] != ( height, width ) :
+			self.buffers[ index ] = np.zeros( ( height, width, 4 ), np.uint8 )
+		return self.buffers[ index ], ticket
+	# Mark the buffer of the given ticket as displayed, and return it (called from the display thread)
+	# Return None if the buffer has already been reused for a newer frame
+	def Display( self, ticket ) :
+		index, generation = ticket
+		with self.lock :
+			if self.generations[ index ] != generation : return None
+			self.displayed = index
+		return self.buffers[ index ]
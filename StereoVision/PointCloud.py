@@ -29,6 +29,27 @@ class PointCloudViewer( QtOpenGL.QGLWidget ) :
 			FragColor.a = 1.0;
 			gl_Position = MVP_Matrix * Vertex;
 		}'''
+	# Vertex shader reprojecting the disparity map (one vertex per pixel, invalid disparities sent out of the clip space)
+	disparity_vertex_shader_source = '''#version 330 core
+		uniform sampler2D Disparity;
+		uniform sampler2D Image;
+		uniform mat4 Q_Matrix;
+		uniform mat4 MVP_Matrix;
+		uniform float Minimum_Disparity;
+		out vec4 FragColor;
+		void main( void ) {
+			ivec2 size = textureSize( Disparity, 0 );
+			ivec2 pixel = ivec2( gl_VertexID % size.x, gl_VertexID / size.x );
+			float disparity = texelFetch( Disparity, pixel, 0 ).r;
+			FragColor.xyz = texelFetch( Image, pixel, 0 ).rgb;
+			FragColor.a = 1.0;
+			if( disparity <= Minimum_Disparity ) {
+				gl_Position = vec4( 2.0, 2.0, 2.0, 1.0 );
+				return;
+			}
+			vec4 point = Q_Matrix * vec4( pixel, disparity, 1.0 );
+			gl_Position = MVP_Matrix * vec4( point.xyz / point.w, 1.0 );
+		}'''
 	# Fragment shader
 	fragment_shader_source = '''#version 330 core
 		in vec4 FragColor;
@@ -56,6 +77,10 @@ class PointCloudViewer( QtOpenGL.QGLWidget ) :
 		QtGui.QShortcut( QtGui.QKeySequence( QtCore.Qt.Key_Escape ), self ).activated.connect( self.close )
 		# Set the R key to reset the view
 		QtGui.QShortcut( QtGui.QKeySequence( QtCore.Qt.Key_R ), self ).activated.connect( self.Reset )
+		# Reproject the disparity maps on the GPU, or display the point clouds computed on the CPU
+		self.gpu_reprojection = False
+		# Set the G key to toggle the GPU reprojection
+		QtGui.QShortcut( QtGui.QKeySequence( QtCore.Qt.Key_G ), self ).activated.connect( self.ToggleGpuReprojection )
 	# Initialize OpenGL
 	def initializeGL( self ) :
 		# Default background color
@@ -71,102 +96,177 @@ class PointCloudViewer( QtOpenGL.QGLWidget ) :
 		gl.glEnable( gl.GL_MULTISAMPLE )
 		# Change point size
 		gl.glPointSize( 5.0 )
-		# Compile the shaders
-		vertex_shader = gl.glCreateShader( gl.GL_VERTEX_SHADER )
-		gl.glShaderSource( vertex_shader, self.vertex_shader_source )
-		gl.glCompileShader( vertex_shader )
-		fragment_shader = gl.glCreateShader( gl.GL_FRAGMENT_SHADER )
-		gl.glShaderSource( fragment_shader, self.fragment_shader_source )
-		gl.glCompileShader( fragment_shader )
 		# Load the shaders
-		self.shader = gl.glCreateProgram()
-		gl.glAttachShader( self.shader, vertex_shader )
-		gl.glAttachShader( self.shader, fragment_shader )
-		gl.glLinkProgram( self.shader )
+		self.shader = self.LoadShaders( self.vertex_shader_source, self.fragment_shader_source )
+		self.disparity_shader = self.LoadShaders( self.disparity_vertex_shader_source, self.fragment_shader_source )
+		# Texture units of the disparity shader
+		gl.glUseProgram( self.disparity_shader )
+		gl.glUniform1i( gl.glGetUniformLocation( self.disparity_shader, b'Disparity' ), 0 )
+		gl.glUniform1i( gl.glGetUniformLocation( self.disparity_shader, b'Image' ), 1 )
 		gl.glUseProgram( self.shader )
-		gl.glDetachShader( self.shader, vertex_shader )
-		gl.glDetachShader( self.shader, fragment_shader )
-		gl.glDeleteShader( vertex_shader )
-		gl.glDeleteShader( fragment_shader )
 		# Initialise the projection transformation matrix
 		self.SetProjectionMatrix()
 		# Initialise Model-View transformation matrix
 		self.modelview_matrix = np.identity( 4, dtype=np.float32 )
+		# Convert the camera coordinates (Y down, Z forward) to the OpenGL coordinates (Y up, Z backward)
+		self.modelview_matrix[1,1] = -1.0
+		self.modelview_matrix[2,2] = -1.0
 		# Position the scene (camera)
 		self.modelview_matrix[3,2] = -30.0
 		# Initialise viewing parameters
 		self.point_cloud_loaded = False
+		# Number of points displayed, and number of points allocated in the buffers
+		self.point_count = 0
+		self.point_capacity = 0
+		# Model matrix, to center and scale the point cloud in the view
+		self.model_matrix = np.identity( 4, dtype=np.float32 )
 		# Vertex array object
 		self.vertex_array_id = gl.glGenVertexArrays( 1 )
 		gl.glBindVertexArray( self.vertex_array_id )
-		# Vertex buffer object
+		# Vertex buffer object (3 floats per point)
 		self.vertex_buffer_id = gl.glGenBuffers( 1 )
-	#	gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.vertex_buffer_id )
-	#	gl.glBufferData( gl.GL_ARRAY_BUFFER, 921600, None, gl.GL_STATIC_DRAW )
-	#	gl.glEnableVertexAttribArray( 0 )
-	#	gl.glVertexAttribPointer( 0, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, None )
-		# Color buffer object
-		self.color_buffer_id = gl.glGenBuffers( 1 )
-	#	gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.color_buffer_id )
-	#	gl.glBufferData( gl.GL_ARRAY_BUFFER, 921600, None, gl.GL_STATIC_DRAW )
-	#	gl.glEnableVertexAttribArray( 1 )
-	#	gl.glVertexAttribPointer( 1, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, None )
-	# Load the point cloud for display
-	def UpdatePointCloud( self, coordinates, colors ) :
-		# Close previous mesh
-		self.Close()
-	#	mask = coordinates[:, 2] > coordinates[:, 2].min()+10
-	#	coordinates = coordinates[ mask ]
-	#	colors = colors[ mask ]
-	#	mask = coordinates[:, 2] < coordinates[:, 2].max()-10
-	#	coordinates = coordinates[ mask ]
-	#	colors = colors[ mask ].astype( np.float32 ) / 255
-		# Cast input data (required for OpenGL)
-		vertices = np.array( coordinates, dtype=np.float32 )
-	#	vertices[:,1] = -vertices[:,1]
-	#	colors = np.array( colors, dtype=np.float32 ) / 255
-		# Normalize the model
-		center =  0.5 * ( np.amin( vertices, axis = 0 ) + np.amax( vertices, axis = 0 ) )
-		radius = np.sqrt(((center - vertices) ** 2).sum(axis = 1)).max()
-	#	center = ( 160, 120, 60 )
-	#	radius = 200
-	#	print center, radius
-		vertices -= center
-		vertices *= 10.0 / radius
-		gl.glBindVertexArray( self.vertex_array_id )
-		# Vertex buffer object
-	#	self.vertex_buffer_id = gl.glGenBuffers( 1 )
 		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.vertex_buffer_id )
-		gl.glBufferData( gl.GL_ARRAY_BUFFER, vertices.nbytes, vertices, gl.GL_STATIC_DRAW )
 		gl.glEnableVertexAttribArray( 0 )
 		gl.glVertexAttribPointer( 0, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, None )
-	#	gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.vertex_buffer_id )
-	#	gl.glBufferSubData( gl.GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices )
-		# Color buffer object
-	#	self.color_buffer_id = gl.glGenBuffers( 1 )
+		# Color buffer object (3 normalized bytes per point)
+		self.color_buffer_id = gl.glGenBuffers( 1 )
 		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.color_buffer_id )
-		gl.glBufferData( gl.GL_ARRAY_BUFFER, colors.nbytes, colors, gl.GL_STATIC_DRAW )
 		gl.glEnableVertexAttribArray( 1 )
-		gl.glVertexAttribPointer( 1, 3, gl.GL_FLOAT, gl.GL_FALSE, 0, None )
-	#	gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.color_buffer_id )
-	#	gl.glBufferSubData( gl.GL_ARRAY_BUFFER, 0, colors.nbytes, colors )
+		gl.glVertexAttribPointer( 1, 3, gl.GL_UNSIGNED_BYTE, gl.GL_TRUE, 0, None )
+		# Allocate the buffers for a 320x240 point cloud
+		self.AllocateBuffers( 76800 )
+		# Disparity map displayed, and size of the textures
+		self.disparity_loaded = False
+		self.disparity_size = None
+		# Empty vertex array object, the disparity shader only uses the vertex index
+		self.disparity_array_id = gl.glGenVertexArrays( 1 )
+		# Disparity texture (one float per pixel) and color texture
+		self.disparity_texture_id, self.image_texture_id = gl.glGenTextures( 2 )
+		for texture_id in ( self.disparity_texture_id, self.image_texture_id ) :
+			gl.glBindTexture( gl.GL_TEXTURE_2D, texture_id )
+			gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST )
+			gl.glTexParameteri( gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST )
+		# Image rows are not aligned
+		gl.glPixelStorei( gl.GL_UNPACK_ALIGNMENT, 1 )
+	# Compile and link the given shaders
+	def LoadShaders( self, vertex_shader_source, fragment_shader_source ) :
+		# Compile the shaders
+		vertex_shader = gl.glCreateShader( gl.GL_VERTEX_SHADER )
+		gl.glShaderSource( vertex_shader, vertex_shader_source )
+		gl.glCompileShader( vertex_shader )
+		fragment_shader = gl.glCreateShader( gl.GL_FRAGMENT_SHADER )
+		gl.glShaderSource( fragment_shader, fragment_shader_source )
+		gl.glCompileShader( fragment_shader )
+		# Load the shaders
+		shader = gl.glCreateProgram()
+		gl.glAttachShader( shader, vertex_shader )
+		gl.glAttachShader( shader, fragment_shader )
+		gl.glLinkProgram( shader )
+		gl.glDetachShader( shader, vertex_shader )
+		gl.glDetachShader( shader, fragment_shader )
+		gl.glDeleteShader( vertex_shader )
+		gl.glDeleteShader( fragment_shader )
+		return shader
+	# Allocate the buffer objects for the given number of points
+	def AllocateBuffers( self, capacity ) :
+		self.point_capacity = capacity
+		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.vertex_buffer_id )
+		gl.glBufferData( gl.GL_ARRAY_BUFFER, capacity * 12, None, gl.GL_STREAM_DRAW )
+		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.color_buffer_id )
+		gl.glBufferData( gl.GL_ARRAY_BUFFER, capacity * 3, None, gl.GL_STREAM_DRAW )
+	# Load the point cloud for display
+	def UpdatePointCloud( self, coordinates, colors ) :
+		# Cast input data (required for OpenGL), the colors are 8-bit RGB
+		vertices = np.ascontiguousarray( coordinates, dtype=np.float32 )
+		colors = np.ascontiguousarray( colors, dtype=np.uint8 )
+		# Normalize the model with the model matrix (the vertices are uploaded unchanged)
+		self.SetModelMatrix( np.amin( vertices, axis = 0 ), np.amax( vertices, axis = 0 ) )
+		# Upload the point cloud in the current OpenGL context
+		self.makeCurrent()
+		# Grow the buffers only when needed (with some margin)
+		if len( vertices ) > self.point_capacity : self.AllocateBuffers( int( len( vertices ) * 1.5 ) )
+		# Orphan the previous buffer storage (no synchronization with the pending draw calls), and upload the new points
+		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.vertex_buffer_id )
+		gl.glBufferData( gl.GL_ARRAY_BUFFER, self.point_capacity * 12, None, gl.GL_STREAM_DRAW )
+		gl.glBufferSubData( gl.GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices )
+		gl.glBindBuffer( gl.GL_ARRAY_BUFFER, self.color_buffer_id )
+		gl.glBufferData( gl.GL_ARRAY_BUFFER, self.point_capacity * 3, None, gl.GL_STREAM_DRAW )
+		gl.glBufferSubData( gl.GL_ARRAY_BUFFER, 0, colors.nbytes, colors )
 		# Setup model element number
+		self.point_count = len( vertices )
 		self.point_cloud_loaded = True
+		self.disparity_loaded = False
+		# Refresh display
+		self.update()
+	# Load the disparity map and the rectified image (BGR) for display, the points are reprojected on the GPU
+	def UpdateDisparity( self, disparity, image, Q, min_disparity = 0 ) :
+		# Cast input data (required for OpenGL)
+		disparity = np.ascontiguousarray( disparity, dtype=np.float32 )
+		image = np.ascontiguousarray( image, dtype=np.uint8 )
+		height, width = disparity.shape
+		# Disparity-to-depth matrix, and validity threshold
+		self.Q_matrix = np.array( Q, dtype=np.float32 )
+		self.minimum_disparity = max( min_disparity - 1, 0 )
+		# Normalize the model with the bounding box of the image corners at the valid disparity range
+		valid = disparity[ disparity > self.minimum_disparity ]
+		if valid.size :
+			corners = np.array( [ [ x, y, d, 1 ] for x in ( 0, width ) for y in ( 0, height ) for d in ( valid.min(), valid.max() ) ], dtype=np.float64 )
+			corners = np.dot( corners, np.array( Q, dtype=np.float64 ).T )
+			corners = corners[:, :3] / corners[:, 3:]
+			self.SetModelMatrix( corners.min( axis = 0 ), corners.max( axis = 0 ) )
+		# Upload the textures in the current OpenGL context
+		self.makeCurrent()
+		# Allocate the textures only when the size changes
+		if self.disparity_size != ( width, height ) :
+			self.disparity_size = ( width, height )
+			gl.glBindTexture( gl.GL_TEXTURE_2D, self.disparity_texture_id )
+			gl.glTexImage2D( gl.GL_TEXTURE_2D, 0, gl.GL_R32F, width, height, 0, gl.GL_RED, gl.GL_FLOAT, None )
+			gl.glBindTexture( gl.GL_TEXTURE_2D, self.image_texture_id )
+			gl.glTexImage2D( gl.GL_TEXTURE_2D, 0, gl.GL_RGB8, width, height, 0, gl.GL_BGR, gl.GL_UNSIGNED_BYTE, None )
+		# Upload the disparity map and the image
+		gl.glBindTexture( gl.GL_TEXTURE_2D, self.disparity_texture_id )
+		gl.glTexSubImage2D( gl.GL_TEXTURE_2D, 0, 0, 0, width, height, gl.GL_RED, gl.GL_FLOAT, disparity )
+		gl.glBindTexture( gl.GL_TEXTURE_2D, self.image_texture_id )
+		gl.glTexSubImage2D( gl.GL_TEXTURE_2D, 0, 0, 0, width, height, gl.GL_BGR, gl.GL_UNSIGNED_BYTE, image )
+		# Display the disparity map instead of the point cloud
+		self.disparity_loaded = True
+		self.point_cloud_loaded = False
 		# Refresh display
 		self.update()
+	# Set the model matrix to center and scale the given bounding box in the view
+	def SetModelMatrix( self, minimum, maximum ) :
+		center = 0.5 * ( minimum + maximum )
+		radius = 0.5 * math.sqrt( ( ( maximum - minimum ) ** 2 ).sum() ) or 1.0
+		self.model_matrix = np.identity( 4, dtype=np.float32 ) * ( 10.0 / radius )
+		self.model_matrix[3] = np.append( - center * 10.0 / radius, 1.0 )
 	# Display the point cloud
 	def paintGL( self ) :
 		# Clear all pixels and depth buffer
 		gl.glClear( gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT )
 		# Nothing to display
-		if not self.point_cloud_loaded : return
+		if not self.point_cloud_loaded and not self.disparity_loaded : return
 		# Apply trackball transformation to the initial model-view matrix
-		modelview_matrix = np.dot( self.transformation, self.modelview_matrix )
+		modelview_matrix = np.dot( self.model_matrix, np.dot( self.transformation, self.modelview_matrix ) )
+		mvp_matrix = np.dot( modelview_matrix, self.projection_matrix )
+		# Draw the disparity map, one point per pixel
+		if self.disparity_loaded :
+			gl.glUseProgram( self.disparity_shader )
+			gl.glUniformMatrix4fv( gl.glGetUniformLocation( self.disparity_shader, b'MVP_Matrix' ), 1, gl.GL_FALSE, mvp_matrix )
+			gl.glUniformMatrix4fv( gl.glGetUniformLocation( self.disparity_shader, b'Q_Matrix' ), 1, gl.GL_TRUE, self.Q_matrix )
+			gl.glUniform1f( gl.glGetUniformLocation( self.disparity_shader, b'Minimum_Disparity' ), self.minimum_disparity )
+			gl.glActiveTexture( gl.GL_TEXTURE0 )
+			gl.glBindTexture( gl.GL_TEXTURE_2D, self.disparity_texture_id )
+			gl.glActiveTexture( gl.GL_TEXTURE1 )
+			gl.glBindTexture( gl.GL_TEXTURE_2D, self.image_texture_id )
+			gl.glBindVertexArray( self.disparity_array_id )
+			gl.glDrawArrays( gl.GL_POINTS, 0, self.disparity_size[0] * self.disparity_size[1] )
+			return
 		# Send the MVP matrix to the shader
-		gl.glUniformMatrix4fv( gl.glGetUniformLocation( self.shader, b'MVP_Matrix' ),
-			1, gl.GL_FALSE, np.dot( modelview_matrix, self.projection_matrix ) )
+		gl.glUseProgram( self.shader )
+		gl.glUniformMatrix4fv( gl.glGetUniformLocation( self.shader, b'MVP_Matrix' ), 1, gl.GL_FALSE, mvp_matrix )
 		# Draw the mesh
-		gl.glDrawArrays( gl.GL_POINTS, 0, 153600 )
+		gl.glBindVertexArray( self.vertex_array_id )
+		gl.glDrawArrays( gl.GL_POINTS, 0, self.point_count )
 	# Resize the Qt widget and the OpenGL viewport
 	def resizeGL( self, width, height ) :
 		# Resize the viewport
@@ -176,12 +276,17 @@ class PointCloudViewer( QtOpenGL.QGLWidget ) :
 	# Close the point cloud
 	def Close( self ) :
 		# Need to initialise ?
-		if not self.point_cloud_loaded : return
-		# Delete buffer objects
-		gl.glDeleteBuffers( 1, np.array([ self.vertex_buffer_id ]) )
-		gl.glDeleteBuffers( 1, np.array([ self.color_buffer_id ]) )
+		if not self.point_cloud_loaded and not self.disparity_loaded : return
+		# Keep the buffer objects and the textures for the next point cloud
+		self.point_count = 0
 		# Initialise the model parameters
 		self.point_cloud_loaded = False
+		self.disparity_loaded = False
+		# Refresh display
+		self.update()
+	# Toggle the GPU reprojection of the disparity maps
+	def ToggleGpuReprojection( self ) :
+		self.gpu_reprojection = not self.gpu_reprojection
 	# Reset the current transformation matrix
 	def Reset( self ) :
 		self.transformation = np.identity( 4, dtype=np.float32 )
@@ -0,0 +1,174 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to record the stereo frames in a compact container, and to read them back
+#
+
+# External dependencies
+import os
+import pickle
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+
+# Files of a recording directory : header, frame data, and frame index
+recording_header = 'header.pkl'
+recording_frames = 'frames.bin'
+recording_index = 'index.bin'
+
+# Frame index record : frame number, capture timestamp (seconds), and location of the left and right images in the frame data
+recording_record = np.dtype( [ ( 'index', '<i8' ), ( 'timestamp', '<f8' ), ( 'offset', '<i8' ), ( 'size_left', '<i8' ), ( 'size_right', '<i8' ) ] )
+
+# Image encodings : raw frames in a memory-mapped file, lossless PNG (fast compression level), or JPEG
+recording_encodings = {
+	'raw' : None,
+	'png' : ( '.png', [ cv2.IMWRITE_PNG_COMPRESSION, 1 ] ),
+	'jpeg' : ( '.jpg', [ cv2.IMWRITE_JPEG_QUALITY, 95 ] ),
+}
+
+# Background recorder of the stereo frames
+# The frames are queued by the acquisition thread, and dropped if the writer thread cannot keep up
+class StereoRecorder( object ) :
+	# Initialisation
+	def __init__( self, directory, encoding = 'raw', queue_size = 32, chunk_frames = 64 ) :
+		# Recording directory
+		self.directory = directory
+		if not os.path.isdir( directory ) : os.makedirs( directory )
+		# Image encoding
+		if encoding not in recording_encodings : raise ValueError( 'Unknown recording encoding {}'.format( encoding ) )
+		self.encoding = encoding
+		# Number of raw frames allocated at once in the frame file
+		self.chunk_frames = chunk_frames
+		# Container files (the header is written with the first frame, once the image size is known)
+		self.header = None
+		self.frame_file = open( os.path.join( directory, recording_frames ), 'w+b' )
+		self.index_file = open( os.path.join( directory, recording_index ), 'wb' )
+		# Memory-mapped chunk of raw frames, and its first frame
+		self.chunk = None
+		self.chunk_start = 0
+		# Frames waiting to be written
+		self.queue = queue.Queue( queue_size )
+		# Number of frames recorded, dropped, and failed
+		self.recorded = 0
+		self.dropped = 0
+		self.failed = 0
+		# Start the writer thread
+		self.thread = threading.Thread( target = self.Run )
+		self.thread.daemon = True
+		self.thread.start()
+	# Number of frames waiting to be written
+	def __len__( self ) :
+		return self.queue.qsize()
+	# Add a stereo frame to record (the images must not be modified afterwards)
+	def Put( self, frame ) :
+		try : self.queue.put_nowait( frame )
+		except queue.Full : self.dropped += 1
+	# Write the pending frames, and close the recording
+	def Close( self ) :
+		self.queue.put( None )
+		self.thread.join()
+	# Write the header of the recording
+	def WriteHeader( self, frame ) :
+		self.header = { 'version' : 1, 'encoding' : self.encoding, 'shape' : frame.image_left.shape, 'dtype' : str( frame.image_left.dtype ), 'created' : time.time() }
+		with open( os.path.join( self.directory, recording_header ), 'wb' ) as header_file : pickle.dump( self.header, header_file )
+		# Size of a raw frame
+		self.image_size = frame.image_left.nbytes
+	# Write the images of a frame, and return their location in the frame file
+	def WriteImages( self, frame ) :
+		# Raw images, copied in the memory-mapped chunk
+		if self.encoding == 'raw' :
+			if frame.image_left.shape != self.header['shape'] or frame.image_right.shape != self.header['shape'] :
+				raise ValueError( 'Image size changed during the recording' )
+			# Map a new chunk of the preallocated file
+			if self.chunk is None or self.recorded >= self.chunk_start + len( self.chunk ) :
+				if self.chunk is not None : self.chunk.flush()
+				self.chunk_start = self.recorded
+				self.frame_file.truncate( ( self.chunk_start + self.chunk_frames ) * 2 * self.image_size )
+				self.chunk = np.memmap( self.frame_file, self.header['dtype'], 'r+', self.chunk_start * 2 * self.image_size,
+					( self.chunk_frames, 2 ) + self.header['shape'] )
+			self.chunk[ self.recorded - self.chunk_start, 0 ] = frame.image_left
+			self.chunk[ self.recorded - self.chunk_start, 1 ] = frame.image_right
+			return self.recorded * 2 * self.image_size, self.image_size, self.image_size
+		# Encoded images, appended to the frame file
+		extension, parameters = recording_encodings[ self.encoding ]
+		images = [ cv2.imencode( extension, image, parameters )[1] for image in ( frame.image_left, frame.image_right ) ]
+		offset = self.frame_file.tell()
+		for image in images : self.frame_file.write( image.tobytes() )
+		return offset, len( images[0] ), len( images[1] )
+	# Write the frames until the recording is closed (writer thread)
+	def Run( self ) :
+		while True :
+			# Get the next frame
+			frame = self.queue.get()
+			if frame is None : break
+			# Write the images, then their index record
+			try :
+				if self.header is None : self.WriteHeader( frame )
+				offset, size_left, size_right = self.WriteImages( frame )
+				np.array( [ ( frame.index, frame.grab_start, offset, size_left, size_right ) ], recording_record ).tofile( self.index_file )
+				self.index_file.flush()
+				self.recorded += 1
+			except Exception as error :
+				self.failed += 1
+				print( 'Cannot record the frame {} ({})...'.format( frame.index, error ) )
+		# Remove the unused part of the last chunk, and close the files
+		if self.chunk is not None :
+			self.chunk.flush()
+			self.chunk = None
+			self.frame_file.truncate( self.recorded * 2 * self.image_size )
+		self.frame_file.close()
+		self.index_file.close()
+		print( 'Recording {} closed ({} frames, {} dropped)...'.format( self.directory, self.recorded, self.dropped ) )
+
+# Random access reader of a stereo recording
+class StereoRecording( object ) :
+	# Initialisation
+	def __init__( self, directory ) :
+		# Read the header
+		self.directory = directory
+		with open( os.path.join( directory, recording_header ), 'rb' ) as header_file : self.header = pickle.load( header_file )
+		# Read the frame index (an incomplete last record is ignored)
+		with open( os.path.join( directory, recording_index ), 'rb' ) as index_file : data = index_file.read()
+		self.index = np.frombuffer( data[ : len( data ) - len( data ) % recording_record.itemsize ], recording_record )
+		# Map the raw frames (copy-on-write, so the images can be modified without changing the file), or open the encoded frames
+		self.frames = None
+		self.frame_file = None
+		if self.header['encoding'] == 'raw' :
+			if len( self.index ) : self.frames = np.memmap( os.path.join( directory, recording_frames ), self.header['dtype'], 'c', 0, ( len( self.index ), 2 ) + self.header['shape'] )
+		else : self.frame_file = open( os.path.join( directory, recording_frames ), 'rb' )
+	# Number of frames
+	def __len__( self ) :
+		return len( self.index )
+	# Capture timestamps of the frames (seconds)
+	@property
+	def timestamps( self ) :
+		return self.index['timestamp']
+	# Return the image size
+	@property
+	def shape( self ) :
+		return self.header['shape']
+	# Mean frame rate of the recording
+	@property
+	def fps( self ) :
+		if len( self.index ) < 2 or self.timestamps[-1] <= self.timestamps[0] : return None
+		return ( len( self.index ) - 1 ) / ( self.timestamps[-1] - self.timestamps[0] )
+	# Return the number of the first frame captured at or after the given time from the start of the recording (seconds)
+	def Seek( self, seconds ) :
+		if not len( self.index ) : return 0
+		return min( int( np.searchsorted( self.timestamps, self.timestamps[0] + seconds ) ), len( self.index ) - 1 )
+	# Read the left and right images of the given frame
+	def ReadImages( self, number ) :
+		# Raw images (no copy until modified)
+		if self.frames is not None : return self.frames[ number, 0 ], self.frames[ number, 1 ]
+		# Decode the images
+		record = self.index[ number ]
+		self.frame_file.seek( int( record['offset'] ) )
+		data = np.frombuffer( self.frame_file.read( int( record['size_left'] + record['size_right'] ) ), np.uint8 )
+		return ( cv2.imdecode( data[ : record['size_left'] ], cv2.IMREAD_UNCHANGED ),
+			cv2.imdecode( data[ record['size_left'] : ], cv2.IMREAD_UNCHANGED ) )
+	# Close the recording
+	def Close( self ) :
+		self.frames = None
+		if self.frame_file : self.frame_file.close()
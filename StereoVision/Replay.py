@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to replay recorded stereo images
+#
+
+# External dependencies
+import glob
+import os
+import time
+import cv2
+from .Camera import StereoFrame, StereoFrameSource, StereoPairing
+from .Recording import StereoRecording
+
+# Find the stereo image pairs (left*.png / right*.png) in a directory
+def StereoImageFiles( directory, extension = 'png' ) :
+	left_files, right_files = [], []
+	for left_file in sorted( glob.glob( '{}/left*.{}'.format( directory, extension ) ) ) :
+		right_file = '{}/right{}'.format( directory, os.path.basename( left_file )[4:] )
+		if not os.path.isfile( right_file ) : continue
+		left_files.append( left_file )
+		right_files.append( right_file )
+	return left_files, right_files
+
+# Name of a stereo pair for the output files (the left image name without its left prefix)
+def StereoPairName( left_file ) :
+	return os.path.splitext( os.path.basename( left_file ) )[0][4:].lstrip( '-_' ) or os.path.basename( left_file )
+
+# Thread to replay recorded stereo frames, in real-time or as fast as possible
+class ReplayStereoSource( StereoFrameSource ) :
+	# Initialisation
+	def __init__( self, fps = None, realtime = True, loop = False, pairing = None ) :
+		# Initialize the thread (no synchronization check by default)
+		super( ReplayStereoSource, self ).__init__( pairing if pairing else StereoPairing( max_skew = None ) )
+		# Replay frame rate
+		self.fps = fps
+		# Wait between the frames to respect the frame rate, or send them as fast as possible
+		self.realtime = realtime
+		# Restart at the end of the recording
+		self.loop = loop
+		# Replay start time
+		self.start_time = None
+	# Wait until the given frame has to be sent
+	def Pace( self, index ) :
+		# Unthrottled replay
+		if not self.realtime or not self.fps : return
+		# Wait for the frame time
+		if self.start_time is None : self.start_time = time.monotonic()
+		delay = self.start_time + index / float( self.fps ) - time.monotonic()
+		if delay > 0 : time.sleep( delay )
+	# Read the two images of the next frame
+	def ReadImages( self, index ) :
+		raise NotImplementedError
+	# Read the next stereo frame, or return None at the end of the recording
+	def ReadFrame( self, index ) :
+		# Respect the frame rate
+		self.Pace( index )
+		# Read the images
+		grab_start = time.monotonic()
+		images = self.ReadImages( index )
+		if images is None : return None
+		timestamp = time.monotonic()
+		# Create the stereo frame
+		return StereoFrame( index, images[0], images[1], ( grab_start, timestamp, timestamp, timestamp, timestamp ) )
+
+# Thread to replay the stereo images of a directory (left*.png / right*.png)
+class ImageStereoSource( ReplayStereoSource ) :
+	# Initialisation
+	def __init__( self, directory, fps = 5, realtime = True, loop = False, pairing = None ) :
+		# Initialize the replay
+		super( ImageStereoSource, self ).__init__( fps, realtime, loop, pairing )
+		# Find the stereo images
+		self.left_files, self.right_files = StereoImageFiles( directory )
+		if not self.left_files : raise IOError( 'No stereo images found in {}'.format( directory ) )
+		# Get the image size
+		self.image_height, self.image_width = cv2.imread( self.left_files[0] ).shape[:2]
+	# Return the image width
+	@property
+	def width( self ) :
+		return self.image_width
+	# Return the image height
+	@property
+	def height( self ) :
+		return self.image_height
+	# Read the two images of the next frame
+	def ReadImages( self, index ) :
+		# End of the recording
+		if index >= len( self.left_files ) and not self.loop : return None
+		index %= len( self.left_files )
+		return cv2.imread( self.left_files[index] ), cv2.imread( self.right_files[index] )
+
+# Thread to replay a side-by-side stereo video, or two synchronized videos
+class VideoStereoSource( ReplayStereoSource ) :
+	# Initialisation
+	def __init__( self, filename, right_filename = None, fps = None, realtime = True, loop = False, pairing = None ) :
+		# Open the videos
+		self.video_left = cv2.VideoCapture( filename )
+		self.video_right = cv2.VideoCapture( right_filename ) if right_filename else None
+		if not self.video_left.isOpened() : raise IOError( 'Cannot open the video {}'.format( filename ) )
+		# Initialize the replay, at the video frame rate by default
+		if not fps : fps = self.video_left.get( cv2.CAP_PROP_FPS )
+		super( VideoStereoSource, self ).__init__( fps, realtime, loop, pairing )
+	# Return the image width
+	@property
+	def width( self ) :
+		width = int( self.video_left.get( cv2.CAP_PROP_FRAME_WIDTH ) )
+		return width if self.video_right else width // 2
+	# Return the image height
+	@property
+	def height( self ) :
+		return int( self.video_left.get( cv2.CAP_PROP_FRAME_HEIGHT ) )
+	# Read the two images of the next frame
+	def ReadImages( self, index ) :
+		# Read the video frames
+		images = self.ReadVideos()
+		# Restart at the end of the videos
+		if images is None and self.loop :
+			for video in ( self.video_left, self.video_right ) :
+				if video : video.set( cv2.CAP_PROP_POS_FRAMES, 0 )
+			images = self.ReadVideos()
+		return images
+	# Read the next frames of the videos
+	def ReadVideos( self ) :
+		found, image_left = self.video_left.read()
+		if not found : return None
+		# Two videos
+		if self.video_right :
+			found, image_right = self.video_right.read()
+			if not found : return None
+			return image_left, image_right
+		# Side-by-side video
+		width = image_left.shape[1] // 2
+		return image_left[:, :width], image_left[:, width:2*width]
+	# Release the videos
+	def Release( self ) :
+		self.video_left.release()
+		if self.video_right : self.video_right.release()
+
+# Thread to replay a stereo recording, at the recorded frame rate by default
+class RecordingStereoSource( ReplayStereoSource ) :
+	# Initialisation
+	def __init__( self, directory, fps = None, realtime = True, loop = False, pairing = None, start = 0.0 ) :
+		# Open the recording
+		self.recording = StereoRecording( directory )
+		if not len( self.recording ) : raise IOError( 'No stereo frames recorded in {}'.format( directory ) )
+		# Initialize the replay
+		super( RecordingStereoSource, self ).__init__( fps or self.recording.fps, realtime, loop, pairing )
+		# First frame replayed (seconds from the start of the recording)
+		self.first_frame = self.recording.Seek( start )
+	# Return the image width
+	@property
+	def width( self ) :
+		return self.recording.shape[1]
+	# Return the image height
+	@property
+	def height( self ) :
+		return self.recording.shape[0]
+	# Read the two images of the next frame
+	def ReadImages( self, index ) :
+		number = self.first_frame + index
+		# End of the recording
+		if number >= len( self.recording ) :
+			if not self.loop : return None
+			number = self.first_frame + index % ( len( self.recording ) - self.first_frame )
+		return self.recording.ReadImages( number )
+	# Close the recording
+	def Release( self ) :
+		self.recording.Close()
@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+
+#
+# Module to reproject the disparity maps to 3D point clouds
+#
+
+# External dependencies
+import cv2
+import numpy as np
+
+# Reproject the valid disparities to metric 3D points with the disparity-to-depth matrix
+class Reprojection( object ) :
+	# Initialisation
+	def __init__( self, Q, min_disparity = 0 ) :
+		# Set the disparity-to-depth matrix
+		self.SetMatrix( Q, min_disparity )
+	# Change the disparity-to-depth matrix (the rays are computed again on the next frame)
+	def SetMatrix( self, Q, min_disparity = 0 ) :
+		self.Q = np.array( Q, dtype=np.float64 )
+		self.min_disparity = min_disparity
+		self.shape = None
+	# Precompute the pixel rays and the buffers for the given disparity map size
+	def SetResolution( self, height, width ) :
+		self.shape = ( height, width )
+		size = height * width
+		# Homogeneous point of each pixel for a null disparity ( Q . [ x, y, 0, 1 ] )
+		x, y = np.meshgrid( np.arange( width, dtype=np.float64 ), np.arange( height, dtype=np.float64 ) )
+		self.rays = np.empty( ( 4, size ), np.float32 )
+		for i in range( 4 ) :
+			self.rays[i] = ( self.Q[i, 0] * x + self.Q[i, 1] * y + self.Q[i, 3] ).ravel()
+		# Homogeneous point variation per disparity unit ( Q . [ 0, 0, 1, 0 ] )
+		self.slopes = self.Q[:, 2].astype( np.float32 )
+		# Buffers reused between the frames
+		self.mask = np.empty( size, dtype=bool )
+		self.disparities = np.empty( size, np.float32 )
+		self.homogeneous = np.empty( ( 4, size ), np.float32 )
+		self.rgb_image = np.empty( ( height, width, 3 ), np.uint8 )
+		self.coordinates = np.empty( ( size, 3 ), np.float32 )
+		self.colors = np.empty( ( size, 3 ), np.uint8 )
+	# Compute the 3D coordinates and the RGB colors of the valid disparities
+	# The returned arrays are views of buffers overwritten by the next call
+	def Compute( self, disparity, image, valid = None ) :
+		# Rays of the current resolution
+		if self.shape != disparity.shape : self.SetResolution( *disparity.shape )
+		# Valid disparities (optionally restricted by an additional mask)
+		np.greater( disparity.ravel(), max( self.min_disparity - 1, 0 ), out = self.mask )
+		if valid is not None : np.logical_and( self.mask, valid.ravel(), out = self.mask )
+		count = np.count_nonzero( self.mask )
+		disparities = np.compress( self.mask, disparity.ravel(), out = self.disparities[:count] )
+		# Homogeneous coordinates of the valid points
+		homogeneous = self.homogeneous[:, :count]
+		for i in range( 4 ) :
+			np.compress( self.mask, self.rays[i], out = homogeneous[i] )
+			if self.slopes[i] : homogeneous[i] += self.slopes[i] * disparities
+		# Metric coordinates
+		coordinates = self.coordinates[:count]
+		for i in range( 3 ) : np.divide( homogeneous[i], homogeneous[3], out = coordinates[:, i] )
+		# Colors of the valid points
+		cv2.cvtColor( image, cv2.COLOR_BGR2RGB, self.rgb_image )
+		colors = np.compress( self.mask, self.rgb_image.reshape( -1, 3 ), axis = 0, out = self.colors[:count] )
+		return coordinates, colors
@@ -12,12 +12,47 @@ from PySide import QtCore
 from PySide import QtGui
 import StereoVision as sv
 
+# Widget to paint the stereo images, at a repaint rate capped independently of the processing rate
+class StereoImageWidget( QtGui.QWidget ) :
+	# Initialization
+	def __init__( self, parent = None, max_fps = 30 ) :
+		# Initialise QWidget
+		super( StereoImageWidget, self ).__init__( parent )
+		# Displayed image (the Qt image wraps the BGRX buffer without copy)
+		self.buffer = None
+		self.qimage = None
+		# New image not painted yet
+		self.pending = False
+		# Repaint the latest image at the maximum rate
+		self.timer = QtCore.QTimer( self )
+		self.timer.timeout.connect( self.Repaint )
+		self.timer.start( 1000 // max_fps )
+	# Set the image to display (32-bit BGRX buffer, kept until the next image)
+	def SetImage( self, buffer ) :
+		self.buffer = buffer
+		self.qimage = QtGui.QImage( buffer, buffer.shape[1], buffer.shape[0], buffer.strides[0], QtGui.QImage.Format_RGB32 )
+		self.pending = True
+	# Repaint the widget if a new image is available
+	def Repaint( self ) :
+		if not self.pending : return
+		self.pending = False
+		self.update()
+	# Paint the image, scaled only if its size differs from the widget size
+	def paintEvent( self, event ) :
+		if self.qimage is None : return
+		painter = QtGui.QPainter( self )
+		if self.qimage.size() == self.size() : painter.drawImage( 0, 0, self.qimage )
+		else : painter.drawImage( self.rect(), self.qimage )
+		painter.end()
+
 # Stereovision user interface
 class StereoVision( QtGui.QWidget ) :
-	# Signal sent to update the image in the widget
-	update_stereo_images = QtCore.Signal( np.ndarray, np.ndarray )
+	# Signal sent to update the image in the widget
+	update_stereo_images = QtCore.Signal()
+	# Signal sent to update the fused point cloud in the viewer
+	update_fused_point_cloud = QtCore.Signal()
 	# Initialization
-	def __init__( self, parent = None ) :
+	def __init__( self, parent = None, stereo_source = None ) :
 		# Initialise QWidget
 		super( StereoVision, self ).__init__( parent )
 		# Load the calibration parameter file, if it exists
@@ -25,16 +60,21 @@ class StereoVision( QtGui.QWidget ) :
 		if not self.calibration : sv.CreateCalibrationDirectory()
 		# Initialize the viewing parameters
 		self.chessboard_enabled = False
+		# Background chessboard detection, while the preview is enabled
+		self.chessboard_preview = None
 		self.cross_enabled = False
 		self.rectification_enabled = False
 		self.disparity_enabled = False
+		self.fusion_enabled = False
+		# Stereo frame recorder, while recording
+		self.recorder = None
 		# Set the window title
 		self.setWindowTitle( 'StereoVision' )
 		# Connect the signal to update the image
 		self.update_stereo_images.connect( self.UpdateStereoImages )
+		self.update_fused_point_cloud.connect( self.UpdateFusedPointCloud )
 		# Widget to display the images from the cameras
-		self.image_widget = QtGui.QLabel( self )
-		self.image_widget.setScaledContents( True )
+		self.image_widget = StereoImageWidget( self )
 		# Widget elements
 		self.button_cross = QtGui.QPushButton( 'Cross', self )
 		self.button_cross.setCheckable( True )
@@ -57,6 +97,14 @@ class StereoVision( QtGui.QWidget ) :
 		self.button_reconstruction.setCheckable( True )
 		self.button_reconstruction.setShortcut( 'F5' )
 		self.button_reconstruction.clicked.connect( self.ToggleReconstruction )
+		self.button_fusion = QtGui.QPushButton( 'Fusion', self )
+		self.button_fusion.setCheckable( True )
+		self.button_fusion.setShortcut( 'F6' )
+		self.button_fusion.clicked.connect( self.ToggleFusion )
+		self.button_record = QtGui.QPushButton( 'Record', self )
+		self.button_record.setCheckable( True )
+		self.button_record.setShortcut( 'F7' )
+		self.button_record.clicked.connect( self.ToggleRecording )
 		self.spinbox_pattern_rows = QtGui.QSpinBox( self )
 		self.spinbox_pattern_rows.setValue( sv.pattern_size[0] )
 		self.spinbox_pattern_rows.valueChanged.connect( self.UpdatePatternSize )
@@ -69,6 +117,7 @@ class StereoVision( QtGui.QWidget ) :
 		self.button_save_mesh = QtGui.QPushButton( 'Save Mesh', self )
 		self.button_save_mesh.setShortcut( 'Enter' )
 		self.button_save_mesh.clicked.connect( self.SaveMesh )
+		self.label_statistics = QtGui.QLabel( self )
 		# Widget layout
 		self.layout_pattern_size = QtGui.QHBoxLayout()
 		self.layout_pattern_size.addWidget( QtGui.QLabel( 'Calibration pattern size :' ) )
@@ -80,9 +129,12 @@ class StereoVision( QtGui.QWidget ) :
 		self.layout_controls.addWidget( self.button_calibration )
 		self.layout_controls.addWidget( self.button_rectification )
 		self.layout_controls.addWidget( self.button_reconstruction )
+		self.layout_controls.addWidget( self.button_fusion )
+		self.layout_controls.addWidget( self.button_record )
 		self.layout_controls.addLayout( self.layout_pattern_size )
 		self.layout_controls.addWidget( self.button_save_images )
 		self.layout_controls.addWidget( self.button_save_mesh )
+		self.layout_controls.addWidget( self.label_statistics )
 		self.layout_global = QtGui.QVBoxLayout( self )
 		self.layout_global.addWidget( self.image_widget )
 		self.layout_global.addLayout( self.layout_controls )
@@ -93,83 +145,167 @@ class StereoVision( QtGui.QWidget ) :
 		self.disparity = sv.StereoSGBM()
 		# Point cloud viewer
 		self.pointcloud_viewer = sv.PointCloudViewer()
-		self.X, self.Y = np.meshgrid( np.arange( 320 ), np.arange( 240 ) )
-		# Initialize the USB stereo cameras
-		self.stereo_camera = sv.UsbStereoCamera()
-		# Lower the camera frame rate and resolution
-		self.stereo_camera.camera_left.set( cv2.CAP_PROP_FRAME_WIDTH, 640 )
-		self.stereo_camera.camera_left.set( cv2.CAP_PROP_FRAME_HEIGHT, 480 )
-		self.stereo_camera.camera_right.set( cv2.CAP_PROP_FRAME_WIDTH, 640 )
-		self.stereo_camera.camera_right.set( cv2.CAP_PROP_FRAME_HEIGHT, 480 )
-		self.stereo_camera.camera_left.set( cv2.CAP_PROP_FPS, 5 )
-		self.stereo_camera.camera_right.set( cv2.CAP_PROP_FPS, 5 )
+		# Reprojection of the disparity map to a point cloud (created with the calibration), and scale of the matched images
+		self.reprojection = None
+		self.reprojection_scale = None
+		# Point cloud filter (points behind the cameras)
+		self.point_filter = sv.PointCloudFilter()
+		# Export the filtered point clouds in the background
+		self.ply_writer = sv.PlyWriter( point_filter = self.point_filter )
+		# Fusion of the successive point clouds (the cameras are assumed static)
+		self.voxel_map = sv.VoxelMap()
+		# Latest point cloud of the map, reprojection of the fusion thread, and time of the latest map update in the viewer
+		self.fused_point_cloud = None
+		self.fusion_reprojection = None
+		self.fusion_display_time = 0.0
+		# Minimum time between two updates of the map in the viewer (seconds)
+		self.fusion_display_interval = 0.5
+		# Initialize the stereo frame source, by default the USB stereo cameras with a lower frame rate and resolution
+		self.stereo_camera = stereo_source if stereo_source else sv.UsbStereoCamera( width = 640, height = 480, fps = 5 )
 		# Fix the widget size
 		self.image_widget.setFixedSize( self.stereo_camera.width * 2, self.stereo_camera.height )
-		# Start image acquisition
+		# Display images reused across frames
+		self.display_buffers = sv.DisplayBuffers()
+		# Process the images in a background thread, only the latest frame is kept
+		self.processor = sv.FrameProcessor( self.ProcessStereoImages, self.update_stereo_images.emit )
+		self.processor.StartProcessing()
+		# Fuse the point clouds in a background thread, only the latest disparity map is kept
+		self.fusion = sv.FrameProcessor( self.FusePointCloud, self.update_fused_point_cloud.emit )
+		self.fusion.StartProcessing()
+		# Start image acquisition
 		self.stereo_camera.StartCapture(  self.ImageCallback  )
 	# Receive the frame sent by the camera
-	def ImageCallback( self, image_left, image_right ) :
-		# Process the images
-		self.update_stereo_images.emit( image_left, image_right )
-	# Process the given stereo images
-	def UpdateStereoImages( self, image_left, image_right ) :
+	def ImageCallback( self, frame ) :
+		# Record the frame
+		recorder = self.recorder
+		if recorder : recorder.Put( frame )
+		# Send the images to the processing thread
+		self.processor.Put( frame )
+	# Process the given stereo images (in the processing thread)
+	def ProcessStereoImages( self, frame ) :
 		# Get the images
-		self.image_left = image_left
-		self.image_right = image_right
-		# Copy images for display
-		image_left_displayed = np.copy( self.image_left )
-		image_right_displayed = np.copy( self.image_right )
-		# Preview the calibration chessboard on the image
-		if self.chessboard_enabled :
-			image_left_displayed = sv.PreviewChessboard( image_left_displayed )
-			image_right_displayed = sv.PreviewChessboard( image_right_displayed )
-		# Display a cross in the middle of the image
-		if self.cross_enabled :
-			cv2.line( image_left_displayed, (image_left_displayed.shape[1]/2, 0), (image_left_displayed.shape[1]/2, image_left_displayed.shape[0]), (0, 0, 255), 4 )
-			cv2.line( image_left_displayed, (0, image_left_displayed.shape[0]/2), (image_left_displayed.shape[1], image_left_displayed.shape[0]/2), (0, 0, 255), 4 )
-			cv2.line( image_right_displayed, (image_right_displayed.shape[1]/2, 0), (image_right_displayed.shape[1]/2, image_right_displayed.shape[0]), (0, 0, 255), 4 )
-			cv2.line( image_right_displayed, (0, image_right_displayed.shape[0]/2), (image_right_displayed.shape[1], image_right_displayed.shape[0]/2), (0, 0, 255), 4 )
-		# Display the rectifed images
+		image_left, image_right = frame.image_left, frame.image_right
+		result = { 'frame' : frame }
+		# Display the rectifed images
 		if self.rectification_enabled and self.calibration :
 			# Undistort the images according to the stereo camera calibration parameters
-			rectified_images = sv.StereoRectification( self.calibration, image_left, image_right, True )
-			# Prepare image for display
-			stereo_image = np.concatenate( rectified_images, axis=1 )
-		# Display the disparity image
+			displayed_images = sv.StereoRectification( self.calibration, image_left, image_right, True )
+			# No chessboard preview on the rectification lines
+			chessboard_preview = None
+		# Display the disparity image
 		elif self.disparity_enabled and self.calibration :
 			# Undistort the images according to the stereo camera calibration parameters
+			# Skip the badly synchronized pairs (no result)
+			if not frame.synchronized : return None
 			rectified_images = sv.StereoRectification( self.calibration, image_left, image_right )
-			rectified_images = cv2.pyrDown( rectified_images[0] ), cv2.pyrDown( rectified_images[1] )
-			# Compute the disparity
+			# Match the full resolution images coarse-to-fine, or the downscaled images
+			result['disparity_scale'] = 1.0 if self.disparity.parameters['coarse_levels'] > 0 else 0.5
+			if result['disparity_scale'] < 1.0 : rectified_images = cv2.pyrDown( rectified_images[0] ), cv2.pyrDown( rectified_images[1] )
+			# Compute the disparity
 			self.disparity.ComputeDisparity( *rectified_images )
+			# Keep the disparity and the color image for the point cloud
+			result['disparity'] = self.disparity.disparity, rectified_images[0], self.disparity.valid
 			# Display the dispariy image
-			stereo_image = cv2.pyrUp( self.disparity.disparity_image )
-			# Point cloud
-			self.coordinates = np.array( (self.X.flatten(), self.Y.flatten(), self.disparity.disparity.flatten() * 0.5) ).T
-			self.coordinates = self.coordinates.reshape(-1, 3)
-			self.coordinates[:,1] = -self.coordinates[:,1]
-			self.colors = np.array( cv2.cvtColor( rectified_images[0], cv2.COLOR_BGR2RGB ), dtype=np.float32 ) / 255
-			self.colors = self.colors.reshape(-1, 3)
-			self.pointcloud_viewer.UpdatePointCloud( self.coordinates, self.colors )
-		# Prepare image for display
-		else : stereo_image = np.concatenate( (image_left_displayed, image_right_displayed), axis=1 )
-		# Convert image color format from BGR to RGB
-		stereo_image = cv2.cvtColor( stereo_image, cv2.COLOR_BGR2RGB )
-		# Create a Qt image
-		qimage = QtGui.QImage( stereo_image, stereo_image.shape[1], stereo_image.shape[0], QtGui.QImage.Format_RGB888 )
-		# Set the image to the Qt widget
-		self.image_widget.setPixmap( QtGui.QPixmap.fromImage( qimage ) )
-		# Update the widget
-		self.image_widget.update()
+			stereo_image, result['display'] = self.display_buffers.Acquire( image_left.shape[0], image_left.shape[1] )
+			self.disparity.DrawDisparity( stereo_image )
+			return result
+		# Display the camera images, and send them to the chessboard detection
+		else :
+			displayed_images = image_left, image_right
+			chessboard_preview = self.chessboard_preview
+			if chessboard_preview : chessboard_preview.Put( displayed_images )
+		# Compose the images side by side in a display buffer
+		height, width = displayed_images[0].shape[:2]
+		stereo_image, result['display'] = self.display_buffers.Acquire( height, width * 2 )
+		for camera, image, displayed_image in zip( ( 0, 1 ), displayed_images, ( stereo_image[:, :width], stereo_image[:, width:] ) ) :
+			cv2.cvtColor( image, cv2.COLOR_BGR2BGRA, dst = displayed_image )
+			# Preview the latest calibration chessboard found on the image
+			if chessboard_preview :
+				found = chessboard_preview.Draw( camera, displayed_image )
+				cv2.putText( displayed_image, 'Pattern found' if found else 'No pattern', ( 10, 30 ),
+					cv2.FONT_HERSHEY_SIMPLEX, 1, ( 0, 255, 0 ) if found else ( 0, 0, 255 ), 2 )
+			# Display a cross in the middle of the image
+			if self.cross_enabled :
+				cv2.line( displayed_image, ( width // 2, 0 ), ( width // 2, height ), ( 0, 0, 255 ), 4 )
+				cv2.line( displayed_image, ( 0, height // 2 ), ( width, height // 2 ), ( 0, 0, 255 ), 4 )
+		# Return the processing results
+		return result
+	# Display the latest processing results (in the GUI thread)
+	def UpdateStereoImages( self ) :
+		# Get the latest results
+		result = self.processor.TakeResult()
+		if result is None : return
+		# Get the images
+		self.image_left, self.image_right = result['frame'].image_left, result['frame'].image_right
+		# Update the point cloud
+		if 'disparity' in result :
+			# Disparity-to-depth matrix of the matched images (recreated when their scale changes)
+			if self.reprojection is None or self.reprojection_scale != result['disparity_scale'] :
+				self.reprojection_scale = result['disparity_scale']
+				self.reprojection = sv.Reprojection( sv.DisparityToDepthMatrix( self.calibration, scale = self.reprojection_scale ) )
+			self.reprojection.min_disparity = self.disparity.parameters['min_disparity']
+			# Keep the latest disparity map for the export
+			self.point_disparity = result['disparity']
+			# Fuse the point cloud into the voxel map (in the fusion thread)
+			if self.fusion_enabled :
+				self.fusion.Put( result['disparity'] + ( self.reprojection.Q, self.reprojection.min_disparity ) )
+			# Reproject the valid disparities on the GPU
+			elif self.pointcloud_viewer.gpu_reprojection :
+				disparity, image, valid = result['disparity']
+				# Invalidate the inconsistent disparities
+				if valid is not None : disparity = np.where( valid, disparity, np.float32( self.reprojection.min_disparity - 1 ) )
+				self.pointcloud_viewer.UpdateDisparity( disparity, image, self.reprojection.Q, self.reprojection.min_disparity )
+			# Reproject the valid disparities on the CPU
+			else :
+				coordinates, colors = self.point_filter.Apply( *self.reprojection.Compute( *result['disparity'] ) )
+				if len( coordinates ) : self.pointcloud_viewer.UpdatePointCloud( coordinates, colors )
+		# Update the frame counters
+		pairing = self.stereo_camera.pairing
+		self.label_statistics.setText( 'Processed : {}  Dropped : {}  Failed : {}  Unsynchronized : {}  Skew : {:.1f} ms'.format(
+			self.processor.processed, self.processor.dropped + self.processor.dropped_results,
+			self.processor.failed + self.fusion.failed, pairing.rejected, pairing.skew.mean * 1000 ) )
+		# Set the display image to the Qt widget (repainted at the widget rate)
+		stereo_image = self.display_buffers.Display( result['display'] )
+		if stereo_image is not None : self.image_widget.SetImage( stereo_image )
+	# Fuse the point cloud of the given disparity map into the voxel map (in the fusion thread)
+	# Return the point cloud of the map, at most once per display interval
+	def FusePointCloud( self, task ) :
+		disparity, image, valid, Q, min_disparity = task
+		# Reprojection of the fusion thread (the one of the GUI thread reuses its buffers)
+		if self.fusion_reprojection is None or not np.array_equal( self.fusion_reprojection.Q, Q ) :
+			self.fusion_reprojection = sv.Reprojection( Q )
+		self.fusion_reprojection.min_disparity = min_disparity
+		# Integrate the point cloud
+		voxel_map = self.voxel_map
+		voxel_map.Integrate( *self.point_filter.Apply( *self.fusion_reprojection.Compute( disparity, image, valid ) ) )
+		# Capped update rate of the viewer
+		if time.monotonic() < self.fusion_display_time + self.fusion_display_interval : return None
+		self.fusion_display_time = time.monotonic()
+		return voxel_map.PointCloud()
+	# Display the latest point cloud of the map (in the GUI thread)
+	def UpdateFusedPointCloud( self ) :
+		point_cloud = self.fusion.TakeResult()
+		if point_cloud is None or not self.fusion_enabled : return
+		self.fused_point_cloud = point_cloud
+		if len( point_cloud[0] ) : self.pointcloud_viewer.UpdatePointCloud( *point_cloud )
 	# Toggle the chessboard preview
 	def ToggleChessboard( self ) :
 		self.chessboard_enabled = not self.chessboard_enabled
+		# Start the chessboard detection
+		if self.chessboard_enabled :
+			self.chessboard_preview = sv.ChessboardPreview()
+			self.chessboard_preview.StartPreview()
+		# Stop the chessboard detection
+		else :
+			chessboard_preview, self.chessboard_preview = self.chessboard_preview, None
+			chessboard_preview.StopPreview()
 	# Toggle the chessboard preview
 	def ToggleCross( self ) :
 		self.cross_enabled = not self.cross_enabled
 	# Stereo camera calibration
 	def Calibration( self ) :
 		self.calibration = sv.StereoCameraCalibration()
+		self.reprojection = None
 		self.button_calibration.setIcon( self.style().standardIcon( QtGui.QStyle.SP_DialogYesButton ) )
 	# Image rectification
 	def ToggleRectification( self ) :
@@ -187,9 +323,25 @@ class StereoVision( QtGui.QWidget ) :
 		else :
 			self.disparity.hide()
 			self.pointcloud_viewer.hide()
+	# Point cloud fusion
+	def ToggleFusion( self ) :
+		self.fusion_enabled = not self.fusion_enabled
+		# Start a new map (replaced, so the fusion thread never sees a partially cleared map)
+		if self.fusion_enabled :
+			self.voxel_map = sv.VoxelMap()
+			self.fused_point_cloud = None
+	# Stereo frame recording
+	def ToggleRecording( self ) :
+		# Start a new recording
+		if self.recorder is None :
+			self.recorder = sv.StereoRecorder( 'recording-{}'.format( time.strftime( '%Y%m%d_%H%M%S' ) ) )
+		# Stop recording, and write the pending frames
+		else :
+			recorder, self.recorder = self.recorder, None
+			recorder.Close()
 	# Update the calibration pattern size
 	def UpdatePatternSize( self, _ ) :
-		sv.pattern_size = ( self.spinbox_pattern_rows.value(), self.spinbox_pattern_cols.value() )
+		sv.pattern_size = sv.Calibration.pattern_size = ( self.spinbox_pattern_rows.value(), self.spinbox_pattern_cols.value() )
 	# Save the stereo images
 	def SaveImages( self ) :
 		current_time = time.strftime( '%Y%m%d_%H%M%S' )
@@ -204,11 +356,25 @@ class StereoVision( QtGui.QWidget ) :
 	def SaveMesh( self ) :
 		current_time = time.strftime( '%Y%m%d_%H%M%S' )
 		print( 'Save point cloud {} to disk...'.format( current_time ) )
-		sv.WritePly( 'stereo-{}.ply'.format( current_time ), self.coordinates, self.colors )
+		# Latest point cloud of the map, or reprojection of the latest disparity map
+		if self.fusion_enabled :
+			if self.fused_point_cloud is None : return
+			coordinates, colors = self.fused_point_cloud
+		else : coordinates, colors = self.reprojection.Compute( *self.point_disparity )
+		self.ply_writer.Put( 'stereo-{}.ply'.format( current_time ), coordinates.copy(), colors.copy() )
 	# Close the widgets
 	def closeEvent( self, event ) :
 		# Stop image acquisition
 		self.stereo_camera.StopCapture()
+		# Finish the recording
+		if self.recorder : self.recorder.Close()
+		# Stop the chessboard detection
+		if self.chessboard_preview : self.chessboard_preview.StopPreview()
+		# Stop image processing
+		self.processor.StopProcessing()
+		self.fusion.StopProcessing()
+		# Finish the point cloud exports
+		self.ply_writer.Close()
 		# Close child widgets
 		self.pointcloud_viewer.close()
 		self.disparity.close()
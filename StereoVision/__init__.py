@@ -1,10 +1,24 @@
 from . import Calibration
 from .Calibration import *
+from . import Matcher
+from .Matcher import *
+from . import Reprojection
+from .Reprojection import *
+from . import Filter
+from .Filter import *
+from . import Fusion
+from .Fusion import *
 from . import Disparity
 from .Disparity import *
 from . import Camera
 from .Camera import *
+from . import Recording
+from .Recording import *
+from . import Replay
+from .Replay import *
 from . import PointCloud
 from .PointCloud import *
+from . import Pipeline
+from .Pipeline import *
 from . import Widget
 from .Widget import *
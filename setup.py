@@ -14,7 +14,7 @@ setup(
     name = 'StereoVision',
     version = '0.4dev',
     packages = ['StereoVision'],
-    scripts = ['stereovision.py'],
+    scripts = ['stereovision.py', 'stereovision-batch.py'],
     author = 'Michaël Roy',
     author_email = 'microygh@gmail.com',
     description = 'Python Stereo Vision Application',
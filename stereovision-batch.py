@@ -0,0 +1,13 @@
+#! /usr/bin/env python
+# -*- coding:utf-8 -*-
+
+#
+# StereoVision batch reconstruction (no display required)
+#
+
+# External dependencies
+from StereoVision import Batch
+
+# Main application
+if __name__ == '__main__' :
+	Batch.Main()
@@ -6,13 +6,37 @@
 #
 
 # External dependencies
+import argparse
 import sys
 from PySide import QtGui
 import StereoVision as sv
 
 # Main application
 if __name__ == '__main__' :
-	application = QtGui.QApplication( sys.argv )
-	widget = sv.StereoVision()
+	# Command line options (the other ones are left to Qt)
+	parser = argparse.ArgumentParser( description = 'Stereo vision application' )
+	parser.add_argument( '--images', metavar = 'DIRECTORY', help = 'Replay the stereo images (left*.png / right*.png) of a directory' )
+	parser.add_argument( '--video', metavar = 'FILE', nargs = '+', help = 'Replay a side-by-side stereo video, or a left and a right video' )
+	parser.add_argument( '--recording', metavar = 'DIRECTORY', help = 'Replay a stereo recording' )
+	parser.add_argument( '--start', type = float, default = 0.0, help = 'Replay the recording from the given time (seconds)' )
+	parser.add_argument( '--fps', type = float, help = 'Replay frame rate' )
+	parser.add_argument( '--fast', action = 'store_true', help = 'Replay the frames as fast as possible' )
+	parser.add_argument( '--drop-unsynchronized', action = 'store_true', help = 'Drop the camera pairs with a time difference above 15 ms (only skipped by the disparity computation by default)' )
+	parser.add_argument( '--loop', action = 'store_true', help = 'Restart the replay at the end' )
+	args, qt_args = parser.parse_known_args()
+	# Stereo frame source
+	stereo_source = None
+	if args.images :
+		stereo_source = sv.ImageStereoSource( args.images, args.fps or 5, not args.fast, args.loop )
+	elif args.recording :
+		stereo_source = sv.RecordingStereoSource( args.recording, args.fps, not args.fast, args.loop, start = args.start )
+	elif args.video :
+		stereo_source = sv.VideoStereoSource( args.video[0], args.video[1] if len( args.video ) > 1 else None,
+			args.fps, not args.fast, args.loop )
+	elif args.drop_unsynchronized :
+		stereo_source = sv.UsbStereoCamera( width = 640, height = 480, fps = 5, pairing = sv.StereoPairing( drop = True ) )
+	# Start the application
+	application = QtGui.QApplication( sys.argv[:1] + qt_args )
+	widget = sv.StereoVision( stereo_source = stereo_source )
 	widget.show()
 	sys.exit( application.exec_() )